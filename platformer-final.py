@@ -1,8 +1,34 @@
 # Imports
 import pygame
+import argparse
+import array
+import bisect
+import csv
+import glob
+import hashlib
 import json
+import mmap
 import os
+import struct
 import sys
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Headless mode runs without a window or sound and doesn't render, for level
+# checks on machines without a display. Use --headless or PLATFORMER_HEADLESS=1.
+headless = ("--headless" in sys.argv or "--compile-levels" in sys.argv or
+            os.environ.get("PLATFORMER_HEADLESS") == "1")
+
+if headless:
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
 
 # Initialize game engine
 pygame.mixer.pre_init()
@@ -14,10 +40,67 @@ SCREEN_HEIGHT = 576
 TITLE = "Name of Game"
 FPS = 30
 
+# Physics always steps FPS times a second, while frames are drawn up to RENDER_FPS
+# times a second (0 for no limit) with sprites interpolated between steps. When
+# drawing falls behind, at most MAX_CATCHUP_STEPS steps run before the next frame
+# is drawn and any lag beyond that is dropped.
+RENDER_FPS = 60
+MAX_CATCHUP_STEPS = 5
+
 # Optional grid for help with level design
 show_grid = True
 grid_color = (150, 150, 150)
 
+# Static layers are prerendered in chunks (chunk_tiles x chunk_tiles tiles) as the
+# camera gets within chunk_margin pixels of them. The least recently used chunks are
+# dropped once the cached chunks of every level take up more than chunk_budget bytes.
+chunk_tiles = 8
+chunk_margin = 512
+chunk_budget = 48 * 1024 * 1024
+
+# Only redraw the parts of the screen that sprites moved through while the camera is still
+dirty_rects = True
+
+# Update all enemies of a kind together in NumPy arrays (ignored if numpy isn't installed)
+batch_enemies = True
+
+# Items and enemies more than activation_margin pixels outside the camera sleep, and
+# aren't updated or drawn until the camera gets near them again. Sleeping ones still get
+# one update every sleep_interval steps (0 for never). When the level is streamed (see
+# stream_segment) only batched enemies get these updates, since streamed out items and
+# other enemies are just records. None keeps everything awake.
+activation_margin = 1024
+sleep_interval = 0
+
+# Sound effects play on channels set aside for their category. When all of a category's
+# channels are busy, a sound can take a channel from a category with a lower priority.
+# A sound only starts once per step however many times it's played.
+sound_categories = { "player": { "channels": 2, "priority": 2 },
+                     "items": { "channels": 3, "priority": 1 } }
+
+# Long levels are split into segments stream_segment tiles wide. Items and enemies only
+# become sprites while their segment is within activation_margin of the camera, and are
+# packed back into records (keeping where they are and what they were doing) once it
+# moves away. None makes every sprite when the level loads.
+stream_segment = 16
+
+# F3 shows a graph of how long each phase of the last profile_history frames took.
+# Use --profile FILE to save the timings of every frame as CSV or JSON on exit.
+profile_key = pygame.K_F3
+profile_history = 240
+
+# --capture FILE saves a frame for every step to FILE on a background thread, as raw
+# pixels or as numbered PNGs if FILE has a % in it (like frames/%05d.png). Up to
+# capture_buffers frames can be waiting to be written. Frames beyond that are dropped,
+# or with capture_drop = False the game waits for the disk to catch up instead.
+capture_buffers = 60
+capture_drop = True
+
+# --watch reloads the current level whenever its file changes, checked every
+# watch_interval seconds. Only the chunks around tiles that changed are prerendered
+# again, items and enemies still in the file keep their state, and the hero stays put.
+watch_interval = 0.5
+
 screen = pygame.display.set_mode([SCREEN_WIDTH, SCREEN_HEIGHT])
 pygame.display.set_caption(TITLE)
 
@@ -34,75 +117,784 @@ def flip_image(img):
 def load_sound(path):
     return pygame.mixer.Sound(path)
 
-# Helper functions for playing music
-def play_music():
-    pygame.mixer.music.play(-1)
-
-def stop_music():
-    pygame.mixer.music.stop()
-
 # Colors
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
 
+# Assets are loaded the first time they're used, and only once per file. Images
+# packed into sheets by tools/build_atlas.py are cut out of those sheets instead.
+atlas_file = "assets/atlas/atlas.json"
+
+class Assets():
+    '''
+    Assets loads images, sounds and fonts the first time they're asked
+    for and keeps them by path, so a file is only read and decoded once
+    no matter how many things use it. Flipped images are kept too, so
+    every sprite facing left shares the same flipped surface.
+
+    When there is an atlas, images in it are subsurfaces of their sheet,
+    so a whole sheet of images only gets decoded once. Images that were
+    changed after the atlas was built are loaded from their own file.
+    '''
+    
+    def __init__(self):
+        self.images = {}
+        self.flipped = {}
+        self.sounds = {}
+        self.fonts = {}
+        self.masks = {}
+        self.atlas = None
+        self.sheets = {}
+
+    def load_atlas(self):
+        self.atlas = {}
+        self.atlas_sheets = {}
+
+        if os.path.isfile(atlas_file):
+            with open(atlas_file, 'r') as f:
+                index = json.load(f)
+
+            folder = os.path.dirname(atlas_file)
+            self.atlas = index['images']
+            self.atlas_time = os.path.getmtime(atlas_file)
+
+            for name, file_name in index['sheets'].items():
+                self.atlas_sheets[name] = os.path.join(folder, file_name)
+
+    def atlas_entry(self, path):
+        if self.atlas is None:
+            self.load_atlas()
+
+        entry = self.atlas.get(path)
+
+        if entry is not None and os.path.getmtime(path) > self.atlas_time:
+            entry = None
+
+        return entry
+
+    def sheet(self, name):
+        sheet = self.sheets.get(name)
+
+        if sheet is None:
+            sheet = load_image(self.atlas_sheets[name])
+            self.sheets[name] = sheet
+
+        return sheet
+
+    def image(self, path):
+        img = self.images.get(path)
+
+        if img is None:
+            entry = self.atlas_entry(path)
+
+            if entry is not None:
+                img = self.sheet(entry[0]).subsurface(entry[1:])
+            else:
+                img = load_image(path)
+
+            self.images[path] = img
+
+        return img
+
+    def flipped_image(self, path):
+        img = self.flipped.get(path)
+
+        if img is None:
+            img = flip_image(self.image(path))
+            self.flipped[path] = img
+
+        return img
+
+    def mask(self, img):
+        '''
+        Returns the collision mask for img. Masks are made once per
+        image and shared by every sprite that uses it.
+        '''
+        mask = self.masks.get(img)
+
+        if mask is None:
+            mask = pygame.mask.from_surface(img)
+            self.masks[img] = mask
+
+        return mask
+
+    def sound(self, path):
+        snd = self.sounds.get(path)
+
+        if snd is None:
+            snd = load_sound(path)
+            self.sounds[path] = snd
+
+        return snd
+
+    def font(self, font_face, font_size):
+        key = (font_face, font_size)
+        font = self.fonts.get(key)
+
+        if font is None:
+            font = load_font(font_face, font_size)
+            self.fonts[key] = font
+
+        return font
+
+    def warm_level(self, map_data):
+        '''
+        Loads everything a level's JSON refers to ahead of time so
+        nothing has to be decoded in the middle of playing it.
+        '''
+        hero_images.warm()
+
+        for group_name in map_data['tiles']:
+            for element in map_data['tiles'][group_name]:
+                tile_images[element[2]]
+
+        for element in map_data['items']:
+            item_images[element[2]]
+
+        for element in map_data['enemies']:
+            enemy_images[element[2]].warm()
+
+        # Sounds can only be decoded when there's a mixer (see Audio)
+        if audio.enabled:
+            for path in [jump_snd, gem_snd]:
+                self.sound(path)
+
+assets = Assets()
+
+class ImageSet():
+    '''
+    ImageSets say which images a sprite uses without loading them.
+    spec is a dict or a list whose entries are paths, flipped(path),
+    or lists of those, and each entry is loaded through assets the
+    first time it's looked up.
+    '''
+    
+    def __init__(self, spec):
+        self.spec = spec
+        self.loaded = {}
+
+    def __getitem__(self, key):
+        img = self.loaded.get(key)
+
+        if img is None:
+            img = self.resolve(self.spec[key])
+            self.loaded[key] = img
+
+        return img
+
+    def __len__(self):
+        return len(self.spec)
+
+    def resolve(self, entry):
+        if isinstance(entry, list):
+            return [self.resolve(e) for e in entry]
+        elif isinstance(entry, tuple):
+            return assets.flipped_image(entry[1])
+        else:
+            return assets.image(entry)
+
+    def warm(self):
+        if isinstance(self.spec, dict):
+            keys = self.spec.keys()
+        else:
+            keys = range(len(self.spec))
+
+        for key in keys:
+            self[key]
+
+def flipped(path):
+    return ("flipped", path)
+
 # Fonts
-font_xs = load_font(None, 16)
-font_sm = load_font(None, 32)
-font_md = load_font(None, 48)
-font_lg = load_font(None, 64)
-font_xl = load_font("assets/fonts/Cheri.ttf", 80)
+font_xs = (None, 16)
+font_sm = (None, 32)
+font_md = (None, 48)
+font_lg = (None, 64)
+font_xl = ("assets/fonts/Cheri.ttf", 80)
+
+# Rendered text is cached, keeping up to text_cache_size surfaces
+text_cache_size = 512
+
+class TextCache():
+    '''
+    TextCaches keep rendered text keyed by font, string and color, so
+    text that doesn't change (like the HUD between pickups and the grid
+    coordinates) is only rendered once. The least recently used
+    surfaces are dropped once there are more than size of them.
+    '''
+    
+    def __init__(self, size):
+        self.size = size
+        self.surfaces = OrderedDict()
+        self.lock = threading.Lock()
+
+    def render(self, font, text, color):
+        key = (font, text, tuple(color))
+
+        # Levels can be loading on another thread, and fonts can't render two things at once
+        with self.lock:
+            surf = self.surfaces.get(key)
+
+            if surf is None:
+                surf = font.render(text, 1, color)
+                self.surfaces[key] = surf
+
+                if len(self.surfaces) > self.size:
+                    self.surfaces.popitem(last=False)
+            else:
+                self.surfaces.move_to_end(key)
+
+        return surf
+
+text_cache = TextCache(text_cache_size)
+
+def render_text(font, text, color):
+    return text_cache.render(assets.font(*font), text, color)
 
 # Sounds
-jump_snd = load_sound('assets/sounds/jump.ogg')
-gem_snd = load_sound('assets/sounds/gem.ogg')
+jump_snd = 'assets/sounds/jump.ogg'
+gem_snd = 'assets/sounds/gem.ogg'
+
+class Audio():
+    '''
+    Audio plays sound effects from pools of reserved mixer channels, one
+    pool per category, so a burst of one kind of sound can't use up
+    every channel and cut off the others. Sounds played more than once
+    in the same step only start once.
+
+    Music is loaded and started by a worker thread, in the order it's
+    asked for, so switching levels never waits on opening and decoding
+    a music file.
+    '''
+    
+    def __init__(self, categories):
+        self.enabled = pygame.mixer.get_init() is not None
+        self.pools = {}
+        self.priorities = {}
+        self.started = {}
+        self.count = 0
+        self.played = set()
+        self.music_queue = queue.Queue()
+        self.music_thread = None
+        self.music_path = None
+
+        if not self.enabled:
+            return
+
+        reserved = sum(c["channels"] for c in categories.values())
+        pygame.mixer.set_num_channels(max(pygame.mixer.get_num_channels(), reserved))
+        pygame.mixer.set_reserved(reserved)
+        first = 0
+
+        for name, category in categories.items():
+            count = category["channels"]
+            self.pools[name] = [pygame.mixer.Channel(i) for i in range(first, first + count)]
+            self.priorities[name] = category["priority"]
+            first += count
+
+    def new_step(self):
+        self.played.clear()
+
+    def find_channel(self, category):
+        '''
+        Returns an idle channel from category's pool, or else from a pool
+        with a lower priority. If they're all busy, the sound that's been
+        playing the longest in the lowest priority of those pools is cut
+        off.
+        '''
+        priority = self.priorities[category]
+        names = [n for n in self.pools if n == category or self.priorities[n] < priority]
+        names.sort(key=lambda n: (n != category, -self.priorities[n]))
+
+        for name in names:
+            for channel in self.pools[name]:
+                if not channel.get_busy():
+                    return channel
+
+        lowest = min(self.priorities[n] for n in names)
+        channels = [c for n in names if self.priorities[n] == lowest for c in self.pools[n]]
+
+        return min(channels, key=lambda c: self.started.get(c, 0))
+
+    def play(self, path, category):
+        if not self.enabled or path in self.played:
+            return
+
+        self.played.add(path)
+        channel = self.find_channel(category)
+        channel.play(assets.sound(path))
+
+        self.count += 1
+        self.started[channel] = self.count
+
+    def play_music(self, path):
+        self.send_music("play", path)
+
+    def preload_music(self, path):
+        self.send_music("load", path)
+
+    def stop_music(self):
+        self.send_music("stop", None)
+
+    def send_music(self, command, path):
+        if not self.enabled:
+            return
+
+        if self.music_thread is None:
+            self.music_thread = threading.Thread(target=self.run_music, daemon=True)
+            self.music_thread.start()
+
+        self.music_queue.put((command, path))
+
+    def run_music(self):
+        while True:
+            command, path = self.music_queue.get()
+
+            try:
+                if command == "stop":
+                    pygame.mixer.music.stop()
+                else:
+                    if path != self.music_path:
+                        pygame.mixer.music.load(path)
+                        self.music_path = path
+
+                    if command == "play":
+                        pygame.mixer.music.play(-1)
+            except pygame.error as e:
+                self.music_path = None
+                print("Couldn't play " + str(path) + ": " + str(e))
+
+audio = Audio(sound_categories)
 
 # Images
-idle = load_image('assets/images/characters/platformChar_idle.png')
-walk = [load_image('assets/images/characters/platformChar_walk1.png'),
-        load_image('assets/images/characters/platformChar_walk2.png')]
-jump = load_image('assets/images/characters/platformChar_jump.png')
-hurt = load_image('assets/images/characters/platformChar_hurt.png')
+idle = 'assets/images/characters/platformChar_idle.png'
+walk = ['assets/images/characters/platformChar_walk1.png',
+        'assets/images/characters/platformChar_walk2.png']
+jump = 'assets/images/characters/platformChar_jump.png'
+hurt = 'assets/images/characters/platformChar_hurt.png'
                    
-hero_images = { "idle_rt": idle,
-                "walk_rt": walk,
-                "jump_rt": jump,
-                "hurt_rt": hurt,
-                "idle_lt": flip_image(idle),
-                "walk_lt" : [flip_image(img) for img in walk],
-                "jump_lt": flip_image(jump),
-                "hurt_lt": flip_image(hurt) }
+hero_images = ImageSet({ "idle_rt": idle,
+                         "walk_rt": walk,
+                         "jump_rt": jump,
+                         "hurt_rt": hurt,
+                         "idle_lt": flipped(idle),
+                         "walk_lt" : [flipped(path) for path in walk],
+                         "jump_lt": flipped(jump),
+                         "hurt_lt": flipped(hurt) })
              
-tile_images = { "Grass": load_image('assets/images/tiles/platformPack_tile001.png'),
-                "Dirt": load_image('assets/images/tiles/platformPack_tile007.png'),
-                "Platform": load_image('assets/images/tiles/platformPack_tile007.png'),
-                "Plant": load_image('assets/images/tiles/platformPack_tile045.png'),
-                "FlagTop": load_image('assets/images/tiles/medievalTile_166.png'),
-                "FlagPole": load_image('assets/images/tiles/medievalTile_190.png') }
+tile_images = ImageSet({ "Grass": 'assets/images/tiles/platformPack_tile001.png',
+                         "Dirt": 'assets/images/tiles/platformPack_tile007.png',
+                         "Platform": 'assets/images/tiles/platformPack_tile007.png',
+                         "Plant": 'assets/images/tiles/platformPack_tile045.png',
+                         "FlagTop": 'assets/images/tiles/medievalTile_166.png',
+                         "FlagPole": 'assets/images/tiles/medievalTile_190.png' })
         
-basic_enemy_images = [ load_image('assets/images/characters/platformPack_tile024a.png'),
-                       load_image('assets/images/characters/platformPack_tile024b.png') ]
+basic_enemy_images = ImageSet([ 'assets/images/characters/platformPack_tile024a.png',
+                                'assets/images/characters/platformPack_tile024b.png' ])
 
-platform_enemy_images = [ load_image('assets/images/characters/platformPack_tile011a.png'),
-                          load_image('assets/images/characters/platformPack_tile011b.png') ] 
+platform_enemy_images = ImageSet([ 'assets/images/characters/platformPack_tile011a.png',
+                                   'assets/images/characters/platformPack_tile011b.png' ])
 
-item_images = { "Gem": load_image('assets/images/items/platformPack_item008.png') }
+enemy_images = { "BasicEnemy": basic_enemy_images,
+                 "PlatformEnemy": platform_enemy_images }
+
+item_images = ImageSet({ "Gem": 'assets/images/items/platformPack_item008.png' })
 
 # Levels
 levels = ["assets/levels/level_1.json",
           "assets/levels/level_1.json",
           "assets/levels/level_1.json"]
     
+# Spatial indexes
+class TileGrid():
+    '''
+    TileGrids are static occupancy grids for tiles that never move.
+    Each cell is scale x scale pixels and holds every tile whose rect
+    overlaps it, so a collision check only looks at the few cells a
+    rect covers instead of every tile in the level. Tiles that are
+    not aligned to the grid (like the flag pole at 44.8) are stored
+    in each cell they overlap.
+
+    Tiles aren't sprites. Each one is just a position and a kind in
+    flat arrays, and the image (and so the mask and size) is kept once
+    per kind. The cells are packed into flat arrays too, the first time
+    the grid is searched after tiles are added (see pack_cells). collide
+    makes Tile views for the tiles it finds, since that's where code
+    wants rects.
+    '''
+    
+    def __init__(self, scale):
+        self.scale = scale
+        self.x = array.array('l')
+        self.y = array.array('l')
+        self.kind = array.array('l')
+        self.kind_ids = {}
+        self.images = []
+        self.sizes = []
+        self.cells = None
+        self.packed = None
+
+    def __len__(self):
+        return len(self.x)
+
+    def cell_range(self, rect):
+        cols = range(rect.left // self.scale, (rect.right - 1) // self.scale + 1)
+        rows = range(rect.top // self.scale, (rect.bottom - 1) // self.scale + 1)
+
+        return cols, rows
+
+    def add(self, x, y, image):
+        kind = self.kind_ids.get(image)
+
+        if kind is None:
+            kind = len(self.images)
+            self.kind_ids[image] = kind
+            self.images.append(image)
+            self.sizes.append(image.get_size())
+
+        x, y = rect_position(x, y)
+        self.x.append(x)
+        self.y.append(y)
+        self.kind.append(kind)
+        self.cells = None
+        self.packed = None
+
+    def tile(self, index):
+        return Tile(self.x[index], self.y[index], self.images[self.kind[index]])
+
+    def tile_cells(self, index):
+        w, h = self.sizes[self.kind[index]]
+
+        return self.cell_range(pygame.Rect(self.x[index], self.y[index], w, h))
+
+    def pack_cells(self):
+        '''
+        Returns (col0, row0, cols, rows, keys, starts, tiles). Only cells
+        with tiles are stored: keys holds (col - col0) * rows + row - row0
+        for each of them in sorted order, and the indexes of the tiles in
+        the cell with keys[j] are tiles[starts[j]:starts[j + 1]], in the
+        order the tiles were added.
+        '''
+        if self.cells is None:
+            entries = []
+
+            for i in range(len(self.x)):
+                cols, rows = self.tile_cells(i)
+
+                for col in cols:
+                    for row in rows:
+                        entries.append((col, row, i))
+
+            entries.sort()
+
+            if len(entries) > 0:
+                col0 = entries[0][0]
+                row0 = min(row for col, row, i in entries)
+                cols = entries[-1][0] - col0 + 1
+                rows = max(row for col, row, i in entries) - row0 + 1
+            else:
+                col0, row0, cols, rows = 0, 0, 0, 0
+
+            keys = array.array('l')
+            starts = array.array('l')
+            tiles = array.array('l')
+
+            for col, row, i in entries:
+                key = (col - col0) * rows + row - row0
+
+                if len(keys) == 0 or keys[-1] != key:
+                    keys.append(key)
+                    starts.append(len(tiles))
+
+                tiles.append(i)
+
+            starts.append(len(tiles))
+            self.cells = (col0, row0, cols, rows, keys, starts, tiles)
+
+        return self.cells
+
+    def collide(self, rect):
+        '''
+        Returns the tiles that overlap rect in the order they were
+        added, which is the same list spritecollide would return for
+        a group the tiles were added to in that order.
+        '''
+        col0, row0, cols, rows, keys, starts, tiles = self.pack_cells()
+        hits = set()
+        col_range, row_range = self.cell_range(rect)
+
+        for col in col_range:
+            if col < col0 or col >= col0 + cols:
+                continue
+
+            for row in row_range:
+                if row < row0 or row >= row0 + rows:
+                    continue
+
+                key = (col - col0) * rows + row - row0
+                j = bisect.bisect_left(keys, key)
+
+                if j == len(keys) or keys[j] != key:
+                    continue
+
+                for i in tiles[starts[j]:starts[j + 1]]:
+                    x = self.x[i]
+                    y = self.y[i]
+                    w, h = self.sizes[self.kind[i]]
+
+                    if x < rect.right and x + w > rect.left and y < rect.bottom and y + h > rect.top:
+                        hits.add(i)
+
+        return [self.tile(i) for i in sorted(hits)]
+
+    def arrays(self):
+        '''
+        Returns the grid packed into NumPy arrays for batch collision
+        checks: the [left, top, right, bottom] of every tile in the order
+        they were added, a (rows, cols, depth) array with the indexes of
+        the tiles in each cell padded with -1, and the column and row of
+        the first cell.
+        '''
+        if self.packed is None:
+            x = np.array(self.x, np.int64)
+            y = np.array(self.y, np.int64)
+            sizes = np.array(self.sizes, np.int64).reshape(-1, 2)[np.array(self.kind, np.int64)]
+            rects = np.stack([x, y, x + sizes[:, 0], y + sizes[:, 1]], axis=1)
+
+            col0, row0, cols, rows, keys, starts, tiles = self.pack_cells()
+            keys = np.array(keys, np.int64)
+            starts = np.array(starts, np.int64)
+            tiles = np.array(tiles, np.int64)
+            counts = np.diff(starts)
+            depth = int(counts.max()) if len(counts) > 0 else 0
+
+            # Spread each cell's run of tile indexes out along the depth axis
+            cell_tiles = np.full([rows, cols, depth], -1, np.int64)
+            cell = np.repeat(np.arange(len(keys)), counts)
+            cell_tiles[keys[cell] % rows, keys[cell] // rows, np.arange(len(tiles)) - starts[cell]] = tiles
+
+            self.packed = (rects, cell_tiles, col0, row0)
+
+        return self.packed
+
+class SpatialHash():
+    '''
+    SpatialHashes bucket sprites that move (the hero, enemies and
+    items) by the cells their rect overlaps. A sprite calls move
+    whenever its rect changes, and is only rebucketed when it crosses
+    into a different set of cells. Queries only look at the buckets
+    near the rect being tested, so checking one sprite against the
+    others doesn't get slower as the level gets more crowded.
+    '''
+    
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.buckets = {}
+        self.bounds = {}
+        self.order = {}
+        self.count = 0
+
+    def bounds_for(self, rect):
+        left = rect.left // self.cell_size
+        right = (rect.right - 1) // self.cell_size
+        top = rect.top // self.cell_size
+        bottom = (rect.bottom - 1) // self.cell_size
+
+        return left, right, top, bottom
+
+    def cells(self, bounds):
+        left, right, top, bottom = bounds
+
+        for x in range(left, right + 1):
+            for y in range(top, bottom + 1):
+                yield x, y
+
+    def insert(self, sprite):
+        bounds = self.bounds_for(sprite.rect)
+        self.bounds[sprite] = bounds
+        self.order[sprite] = self.count
+        self.count += 1
+
+        for cell in self.cells(bounds):
+            self.buckets.setdefault(cell, set()).add(sprite)
+
+    def remove(self, sprite):
+        bounds = self.bounds.pop(sprite, None)
+
+        if bounds is not None:
+            del self.order[sprite]
+
+            for cell in self.cells(bounds):
+                bucket = self.buckets[cell]
+                bucket.discard(sprite)
+
+                if len(bucket) == 0:
+                    del self.buckets[cell]
+
+    def move(self, sprite):
+        old = self.bounds.get(sprite)
+        new = self.bounds_for(sprite.rect)
+
+        if old is not None and old != new:
+            for cell in self.cells(old):
+                bucket = self.buckets[cell]
+                bucket.discard(sprite)
+
+                if len(bucket) == 0:
+                    del self.buckets[cell]
+
+            for cell in self.cells(new):
+                self.buckets.setdefault(cell, set()).add(sprite)
+
+            self.bounds[sprite] = new
+
+    def query(self, rect):
+        '''
+        Returns the sprites whose rects overlap rect, in the order
+        they were inserted.
+        '''
+        hits = set()
+        bounds = self.bounds_for(rect)
+        left, right, top, bottom = bounds
+
+        # Big rects cover more cells than there are buckets, so look through the buckets instead
+        if (right - left + 1) * (bottom - top + 1) > len(self.buckets):
+            buckets = [bucket for (x, y), bucket in self.buckets.items()
+                       if left <= x <= right and top <= y <= bottom]
+        else:
+            buckets = [self.buckets.get(cell, ()) for cell in self.cells(bounds)]
+
+        for bucket in buckets:
+            for sprite in bucket:
+                if sprite.rect.colliderect(rect):
+                    hits.add(sprite)
+
+        return sorted(hits, key=self.order.get)
+
+    def collide(self, sprite, group, dokill=False, collided=None):
+        '''
+        Works like pygame.sprite.spritecollide, but only tests the
+        members of group that share a bucket with sprite. collided is
+        only called for sprites whose rects overlap.
+        '''
+        hit_list = [s for s in self.query(sprite.rect) if s is not sprite and group.has(s)]
+
+        if collided is not None:
+            hit_list = [s for s in hit_list if collided(sprite, s)]
+
+        if dokill:
+            for hit in hit_list:
+                hit.kill()
+                self.remove(hit)
+
+        return hit_list
+
+class ChunkCache():
+    '''
+    ChunkCaches hold the prerendered chunks of levels' static layers,
+    keyed by (level file, layer, column, row). Chunks without anything
+    in them are stored as None so they don't take up any memory.
+    '''
+    
+    def __init__(self, budget):
+        self.budget = budget
+        self.chunks = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def chunk_bytes(self, chunk):
+        if chunk is None:
+            return 0
+
+        return chunk.get_width() * chunk.get_height() * chunk.get_bytesize()
+
+    # Every level shares the one cache, and the next level can be prefetching on another
+    # thread while this one is drawn, so each change is made under the lock
+    def get(self, key):
+        with self.lock:
+            chunk = self.chunks.get(key, False)
+
+            if chunk is not False:
+                self.chunks.move_to_end(key)
+
+            return chunk
+
+    def put(self, key, chunk):
+        with self.lock:
+            # Both threads can render the same chunk, so one replacing the other isn't counted twice
+            old = self.chunks.pop(key, False)
+
+            if old is not False:
+                self.size -= self.chunk_bytes(old)
+
+            self.chunks[key] = chunk
+            self.size += self.chunk_bytes(chunk)
+
+    def discard(self, key):
+        '''
+        Drops a chunk so it's rendered again the next time it's needed.
+        Returns whether there was one to drop.
+        '''
+        with self.lock:
+            chunk = self.chunks.pop(key, False)
+
+            if chunk is not False:
+                self.size -= self.chunk_bytes(chunk)
+
+            return chunk is not False
+
+    def drop(self, file_path):
+        '''
+        Drops every chunk of a level file.
+        '''
+        with self.lock:
+            for key in [key for key in self.chunks if key[0] == file_path]:
+                self.size -= self.chunk_bytes(self.chunks.pop(key))
+
+    def trim(self, keep):
+        '''
+        Evicts least recently used chunks until the cache fits in its
+        budget, but never the keep most recently used ones.
+        '''
+        with self.lock:
+            while self.size > self.budget and len(self.chunks) > keep:
+                key, chunk = self.chunks.popitem(last=False)
+                self.size -= self.chunk_bytes(chunk)
+
+chunk_cache = ChunkCache(chunk_budget)
+
+# Optional pixel-perfect collisions between the hero and enemies or items, checked
+# only for sprites whose rects already overlap
+pixel_perfect = False
+
+def masks_collide(a, b):
+    offset = [b.rect.x - a.rect.x, b.rect.y - a.rect.y]
+
+    return assets.mask(a.image).overlap(assets.mask(b.image), offset) is not None
+
+# Optional enemy-enemy collisions, enemies turn around when they walk into each other.
+# Bumps are checked once every enemy has moved for the step.
+enemies_bump = False
+
 # Sprite classes
-class Tile(pygame.sprite.Sprite):
+class Tile():
+    '''
+    Tiles are views of one tile in a TileGrid. They have the image,
+    rect and mask a sprite would, but are only made for tiles something
+    has collided with.
+    '''
+    __slots__ = ["image", "rect"]
+    
     def __init__(self, x, y, image):
-        super().__init__()
-
         self.image = image
-        self.mask = pygame.mask.from_surface(self.image)
         self.rect = self.image.get_rect()
         self.rect.x = x
         self.rect.y = y
 
+    @property
+    def mask(self):
+        return assets.mask(self.image)
+
 class Hero(pygame.sprite.Sprite):
     def __init__(self, images):
         super().__init__()
@@ -150,17 +942,17 @@ class Hero(pygame.sprite.Sprite):
     def stop(self):
         self.vx = 0
 
-    def can_jump(self, tiles):
+    def can_jump(self, level):
         self.rect.y += 2
-        hit_list = pygame.sprite.spritecollide(self, tiles, False)
+        hit_list = level.main_grid.collide(self.rect)
         self.rect.y -= 2
 
         return len(hit_list) > 0
         
-    def jump(self, tiles):
-        if self.can_jump(tiles):
+    def jump(self, level):
+        if self.can_jump(level):
             self.vy = -self.jump_power
-            jump_snd.play()
+            audio.play(jump_snd, "player")
 
     def apply_gravity(self, level):
         self.vy += level.gravity
@@ -170,7 +962,7 @@ class Hero(pygame.sprite.Sprite):
 
     def move_and_check_tiles(self, level):
         self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, level.main_tiles, False)
+        hit_list = level.main_grid.collide(self.rect)
 
         for hit in hit_list:
             if self.vx > 0:
@@ -180,7 +972,7 @@ class Hero(pygame.sprite.Sprite):
             self.vx = 0
                 
         self.rect.y += self.vy
-        hit_list = pygame.sprite.spritecollide(self, level.main_tiles, False)
+        hit_list = level.main_grid.collide(self.rect)
 
         for hit in hit_list:
             if self.vy > 0:
@@ -189,8 +981,14 @@ class Hero(pygame.sprite.Sprite):
                 self.rect.top = hit.rect.bottom
             self.vy = 0
 
+    def collided(self):
+        if pixel_perfect:
+            return masks_collide
+        
+        return None
+
     def process_items(self, level):
-        hit_list = pygame.sprite.spritecollide(self, level.items, True)
+        hit_list = level.entity_hash.collide(self, level.items, True, self.collided())
 
         for hit in hit_list:
             self.score += hit.value
@@ -200,7 +998,7 @@ class Hero(pygame.sprite.Sprite):
         if self.hurt_timer > 0:
             self.hurt_timer -= 1
         else:
-            hit_list = pygame.sprite.spritecollide(self, level.enemies, False)
+            hit_list = level.entity_hash.collide(self, level.enemies, False, self.collided())
 
             for hit in hit_list:
                 self.hearts -= 1
@@ -240,6 +1038,7 @@ class Hero(pygame.sprite.Sprite):
         self.apply_gravity(level)
         self.move_and_check_tiles(level)
         self.check_world_edges(level)
+        level.entity_hash.move(self)
         self.process_items(level)
         self.process_enemies(level)
         self.check_goal(level)
@@ -279,7 +1078,7 @@ class BasicEnemy(pygame.sprite.Sprite):
 
     def move_and_check_tiles(self, level):
         self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, level.main_tiles, False)
+        hit_list = level.main_grid.collide(self.rect)
 
         for hit in hit_list:
             if self.vx > 0:
@@ -289,7 +1088,7 @@ class BasicEnemy(pygame.sprite.Sprite):
             self.should_reverse = True
                 
         self.rect.y += self.vy
-        hit_list = pygame.sprite.spritecollide(self, level.main_tiles, False)
+        hit_list = level.main_grid.collide(self.rect)
 
         for hit in hit_list:
             if self.vy > 0:
@@ -306,6 +1105,15 @@ class BasicEnemy(pygame.sprite.Sprite):
         elif self.rect.right > level.width:
             self.rect.right = level.width
             self.should_reverse = True
+
+    def check_enemies(self, level):
+        hit_list = level.entity_hash.collide(self, level.enemies)
+
+        for hit in hit_list:
+            if self.vx > 0 and hit.rect.centerx > self.rect.centerx:
+                self.should_reverse = True
+            elif self.vx < 0 and hit.rect.centerx < self.rect.centerx:
+                self.should_reverse = True
         
     def step(self):
         self.steps = (self.steps + 1) % self.step_rate
@@ -322,12 +1130,20 @@ class BasicEnemy(pygame.sprite.Sprite):
         self.apply_gravity(level)
         self.move_and_check_tiles(level)
         self.check_world_edges(level)
-        
-        if self.should_reverse:
+        level.entity_hash.move(self)
+
+        # With enemies_bump, bump turns the enemy around once every enemy has moved
+        if self.should_reverse and not enemies_bump:
             self.reverse()
             
         self.step()
         self.set_image()
+
+    def bump(self, level):
+        self.check_enemies(level)
+
+        if self.should_reverse:
+            self.reverse()
             
 class PlatformEnemy(BasicEnemy):
     '''
@@ -344,7 +1160,7 @@ class PlatformEnemy(BasicEnemy):
         reverse = False
 
         self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, level.main_tiles, False)
+        hit_list = level.main_grid.collide(self.rect)
 
         for hit in hit_list:
             if self.vx > 0:
@@ -354,7 +1170,7 @@ class PlatformEnemy(BasicEnemy):
             self.should_reverse = True
 
         self.rect.y += 2
-        hit_list = pygame.sprite.spritecollide(self, level.main_tiles, False)
+        hit_list = level.main_grid.collide(self.rect)
         
         on_platform = False
 
@@ -387,181 +1203,1540 @@ class Gem(pygame.sprite.Sprite):
         self.value = 10
 
     def apply(self, hero):
-        gem_snd.play()
+        audio.play(gem_snd, "items")
         hero.score += self.value
         
     def update(self, level):
         '''
         Items may not do anything. If so, this function can
         be deleted. However if an item is animated or it moves,
-        then here is where you can implement that.
+        then here is where you can implement that. Items that
+        move need to tell the level's entity hash about it.
         '''
-        pass
+        level.entity_hash.move(self)
 
-class Level():
-    def __init__(self, file_path):
-        with open(file_path, 'r') as f:
-            data = f.read()
+# Sprite classes for each kind of enemy a level can have
+enemy_kinds = { "BasicEnemy": BasicEnemy,
+                "PlatformEnemy": PlatformEnemy }
 
-        self.map_data = json.loads(data)
+# Batched enemy updates
+def rect_position(x, y):
+    '''
+    Returns x and y rounded the same way as when they're assigned to a
+    sprite's rect.
+    '''
+    rect = pygame.Rect(0, 0, 0, 0)
+    rect.x = x
+    rect.y = y
 
-        self.load_layout()
-        self.load_music()
-        self.load_background()
-        self.load_physics()
-        self.load_tiles()
-        self.load_items()
-        self.load_enemies()
-        self.load_goal()
-        
-        self.generate_layers()
-        self.prerender_inactive_layers()
+    return rect.x, rect.y
 
-        if show_grid:
-            self.make_grid_layer()
+def round_rect_coord(values):
+    '''
+    Rounds the way pygame does when a float is assigned to a Rect
+    coordinate, with halves rounded away from zero.
+    '''
+    return np.where(values >= 0, np.floor(values + 0.5), np.ceil(values - 0.5)).astype(np.int64)
 
-    def load_layout(self):
-        self.scale =  self.map_data['layout']['scale']
-        self.width =  self.map_data['layout']['size'][0] * self.scale
-        self.height = self.map_data['layout']['size'][1] * self.scale
-        self.start_x = self.map_data['layout']['start'][0] * self.scale
-        self.start_y = self.map_data['layout']['start'][1] * self.scale
+class EnemyBatch():
+    '''
+    EnemyBatches update every enemy of one kind together. Positions,
+    velocities and animation counters live in NumPy arrays, and each
+    part of BasicEnemy.update (gravity, moving and checking tiles,
+    turning around at walls and edges, and animating) runs once for
+    the whole batch with the same results as updating the enemies one
+    at a time.
+
+    The enemy sprites are only brought up to date where they're needed,
+    near the camera where they get drawn and can touch the hero. Only
+    those sprites are kept in the level's entity hash. sync brings
+    every sprite up to date. Batches are made from enemy records, and
+    when levels are streamed the sprites only exist while the enemies
+    are in the streamed segments.
+    '''
+    
+    ARRAYS = ["x", "y", "w", "h", "vx", "vy", "steps", "walk_index", "live", "hashed", "moved", "turning"]
+    
+    def __init__(self, kind, records):
+        self.kind = kind
+        self.images = enemy_images[kind.__name__]
+        self.ranks = [r[0] for r in records]
+        self.sprites = [None] * len(records)
+
+        prototype = kind(0, 0, self.images)
+        self.step_rate = prototype.step_rate
+
+        self.x = np.array([r[2] for r in records], np.int64)
+        self.y = np.array([r[3] for r in records], np.int64)
+        self.w = np.full(len(records), prototype.rect.width, np.int64)
+        self.h = np.full(len(records), prototype.rect.height, np.int64)
+        self.vx = np.array([r[4] for r in records], np.int64)
+        self.vy = np.array([r[5] for r in records], np.float64)
+        self.steps = np.array([r[6] for r in records], np.int64)
+        self.walk_index = np.array([r[7] for r in records], np.int64)
+        self.live = np.zeros(len(records), bool)
+        self.hashed = np.zeros(len(records), bool)
+        self.moved = np.zeros(len(records), bool)
+        self.turning = np.zeros(len(records), bool)
+
+    def inside(self, region):
+        return ((self.x < region.right) & (self.x + self.w > region.left) &
+                (self.y < region.bottom) & (self.y + self.h > region.top))
+
+    def stream(self, level, wanted):
+        '''
+        Drops the sprites of enemies outside the wanted segments and
+        returns which enemies inside them need one. With no segments,
+        every enemy needs a sprite.
+        '''
+        if wanted is None:
+            inside = np.ones(len(self.sprites), bool)
+        else:
+            inside = np.isin(self.x // (stream_segment * level.scale), list(wanted))
 
-    def load_music(self):
-        pygame.mixer.music.load(self.map_data['music'])
-        
-    def load_physics(self):
-        self.gravity = self.map_data['physics']['gravity']
-        self.terminal_velocity = self.map_data['physics']['terminal_velocity']
+        for i in np.nonzero(self.live & ~inside)[0].tolist():
+            if self.hashed[i]:
+                level.entity_hash.remove(self.sprites[i])
 
-    def load_background(self):
-        self.bg_color = self.map_data['background']['color']
-        path1 = self.map_data['background']['image1']
-        path2 = self.map_data['background']['image2']
+            self.sprites[i].kill()
+            self.sprites[i] = None
 
-        if os.path.isfile(path1):
-            self.bg_image1 = pygame.image.load(path1).convert_alpha()
-        else:
-            self.bg_image1 = None
+        self.live &= inside
+        self.hashed &= inside
 
-        if os.path.isfile(path2):
-            self.bg_image2 = pygame.image.load(path2).convert_alpha()
-        else:
-            self.bg_image2 = None
+        return np.nonzero(inside & ~self.live)[0].tolist()
 
-        self.parallax_speed1 = self.map_data['background']['parallax_speed1']
-        self.parallax_speed2 = self.map_data['background']['parallax_speed2']
-        
-    def load_tiles(self):
-        self.midground_tiles = pygame.sprite.Group()
-        self.main_tiles = pygame.sprite.Group()
-        self.foreground_tiles = pygame.sprite.Group()
+    def spawn(self, level, i):
+        '''
+        Makes the sprite for enemy i where the batch has it and puts it
+        in the level's enemies and entity hash.
+        '''
+        sprite = self.kind(int(self.x[i]), int(self.y[i]), self.images)
+        sprite.order = self.ranks[i]
+        sprite.image = self.images[self.walk_index[i]]
+        self.sprites[i] = sprite
+        self.live[i] = True
+        self.hashed[i] = True
 
-        for group_name in self.map_data['tiles']:
-            tile_group = self.map_data['tiles'][group_name]
-            
-            for element in tile_group:
-                x = element[0] * self.scale
-                y = element[1] * self.scale
-                kind = element[2]
-
-                t = Tile(x, y, tile_images[kind])
-
-                if group_name == 'midground':
-                    self.midground_tiles.add(t)
-                elif group_name == 'main':
-                    self.main_tiles.add(t)
-                elif group_name == 'foreground':
-                    self.foreground_tiles.add(t)
-            
-    def load_items(self):
-        self.items = pygame.sprite.Group()
-        
-        for element in self.map_data['items']:
+        level.enemies.add(sprite)
+        level.entity_hash.insert(sprite)
+        level.spawned.append(sprite)
+
+    def records(self):
+        name = self.kind.__name__
+
+        return [[self.ranks[i], name, int(self.x[i]), int(self.y[i]), int(self.vx[i]),
+                 float(self.vy[i]), int(self.steps[i]), int(self.walk_index[i])]
+                for i in range(len(self.ranks))]
+
+    def tile_hits(self, grid):
+        '''
+        Returns the indexes of the tiles in grid that each enemy overlaps,
+        one row per enemy padded with -1. A tile that spans more than one
+        cell can show up more than once in a row.
+        '''
+        rects, cells, col0, row0 = grid.arrays()
+        rows, cols, depth = cells.shape
+
+        if cells.size == 0:
+            return np.full([len(self.x), 1], -1, np.int64)
+
+        scale = grid.scale
+        right = self.x + self.w
+        bottom = self.y + self.h
+
+        span_x = np.arange((int(self.w.max()) - 1) // scale + 2)
+        span_y = np.arange((int(self.h.max()) - 1) // scale + 2)
+        cx = (self.x // scale - col0)[:, None] + span_x
+        cy = (self.y // scale - row0)[:, None] + span_y
+        valid_x = (cx >= 0) & (cx < cols) & (cx <= ((right - 1) // scale - col0)[:, None])
+        valid_y = (cy >= 0) & (cy < rows) & (cy <= ((bottom - 1) // scale - row0)[:, None])
+
+        cx = np.clip(cx, 0, cols - 1)
+        cy = np.clip(cy, 0, rows - 1)
+        found = cells[cy[:, :, None], cx[:, None, :]]
+        valid = valid_y[:, :, None, None] & valid_x[:, None, :, None]
+        found = np.where(valid, found, -1).reshape(len(self.x), -1)
+
+        r = rects[found]
+        overlap = ((found >= 0) &
+                   (r[:, :, 0] < right[:, None]) & (r[:, :, 2] > self.x[:, None]) &
+                   (r[:, :, 1] < bottom[:, None]) & (r[:, :, 3] > self.y[:, None]))
+
+        return np.where(overlap, found, -1)
+
+    def first_hit(self, hits):
+        big = np.iinfo(np.int64).max
+        first = np.where(hits >= 0, hits, big).min(axis=1)
+
+        return np.where(first == big, -1, first)
+
+    def move_x(self, level, should_reverse):
+        '''
+        Same as the first half of BasicEnemy.move_and_check_tiles. The
+        last tile hit decides where the enemy ends up.
+        '''
+        rects = level.main_grid.arrays()[0]
+
+        self.x += self.vx
+        last = self.tile_hits(level.main_grid).max(axis=1)
+        hit = last >= 0
+
+        moving_right = hit & (self.vx > 0)
+        moving_left = hit & (self.vx < 0)
+        self.x[moving_right] = rects[last[moving_right], 0] - self.w[moving_right]
+        self.x[moving_left] = rects[last[moving_left], 2]
+        should_reverse |= hit
+
+    def move_y(self, level, should_reverse):
+        '''
+        Same as the second half of BasicEnemy.move_and_check_tiles. vy
+        is zeroed by the first tile hit, so only that one counts.
+        '''
+        rects = level.main_grid.arrays()[0]
+
+        self.y = round_rect_coord(self.y + self.vy)
+        first = self.first_hit(self.tile_hits(level.main_grid))
+        hit = first >= 0
+
+        falling = hit & (self.vy > 0)
+        rising = hit & (self.vy < 0)
+        self.y[falling] = rects[first[falling], 1] - self.h[falling]
+        self.y[rising] = rects[first[rising], 3]
+        self.vy[hit] = 0
+
+    def move_y_on_platform(self, level, should_reverse):
+        '''
+        Same as the second half of PlatformEnemy.move_and_check_tiles.
+        A rising enemy is stopped by the first tile it hits and then
+        treats any other tiles hit as ground, like the loop does once
+        vy is zero.
+        '''
+        rects = level.main_grid.arrays()[0]
+
+        self.y += 2
+        hits = self.tile_hits(level.main_grid)
+        first = self.first_hit(hits)
+        hit = first >= 0
+        rising = hit & (self.vy < 0)
+
+        ground = np.where(rising[:, None] & (hits == first[:, None]), -1, hits)
+        last = ground.max(axis=1)
+        on_ground = last >= 0
+        bumped = rising & ~on_ground
+
+        self.y[bumped] = rects[first[bumped], 3]
+        self.y[on_ground] = rects[last[on_ground], 1] - self.h[on_ground]
+        self.vy[hit] = 0
+
+        r = rects[ground]
+        right = (self.x + self.w)[:, None]
+        on_edge = (((self.vx > 0)[:, None] & (right <= r[:, :, 2])) |
+                   ((self.vx < 0)[:, None] & (self.x[:, None] >= r[:, :, 0])))
+        on_platform = (on_edge & (ground >= 0)).any(axis=1)
+        should_reverse |= ~on_platform
+
+    def check_world_edges(self, level, should_reverse):
+        too_far_left = self.x < 0
+        too_far_right = ~too_far_left & (self.x + self.w > level.width)
+
+        self.x[too_far_left] = 0
+        self.x[too_far_right] = level.width - self.w[too_far_right]
+        should_reverse |= too_far_left | too_far_right
+
+    def bump(self, level):
+        '''
+        Checks the enemies moved since the last bump for other enemies
+        and turns around the ones that need to, like BasicEnemy.bump.
+        '''
+        for i in np.nonzero(self.moved)[0].tolist():
+            sprite = self.sprites[i]
+            sprite.vx = int(self.vx[i])
+            sprite.should_reverse = False
+            sprite.check_enemies(level)
+            self.turning[i] |= sprite.should_reverse
+
+        self.vx[self.turning] *= -1
+        self.moved[:] = False
+        self.turning[:] = False
+
+    def sync_rects(self, level, near):
+        '''
+        Moves the sprites of enemies that are near to where the batch
+        has them and keeps only those sprites in the entity hash.
+        '''
+        for i in np.nonzero(near)[0].tolist():
+            sprite = self.sprites[i]
+
+            if sprite is None:
+                self.spawn(level, i)
+                continue
+
+            sprite.rect.x = int(self.x[i])
+            sprite.rect.y = int(self.y[i])
+
+            if self.hashed[i]:
+                level.entity_hash.move(sprite)
+            else:
+                level.entity_hash.insert(sprite)
+
+        for i in np.nonzero(self.hashed & ~near)[0].tolist():
+            level.entity_hash.remove(self.sprites[i])
+
+        self.hashed = near
+
+    def sync(self):
+        for i, sprite in enumerate(self.sprites):
+            if sprite is None:
+                continue
+
+            sprite.rect.x = int(self.x[i])
+            sprite.rect.y = int(self.y[i])
+            sprite.vx = int(self.vx[i])
+            sprite.vy = float(self.vy[i])
+            sprite.steps = int(self.steps[i])
+            sprite.walk_index = int(self.walk_index[i])
+            sprite.image = self.images[sprite.walk_index]
+
+    def subset(self, index):
+        '''
+        Returns a batch of just the enemies at index, with copies of
+        their arrays. merge puts them back once it has been updated.
+        '''
+        batch = EnemyBatch.__new__(EnemyBatch)
+        batch.kind = self.kind
+        batch.sprites = [self.sprites[i] for i in index.tolist()]
+        batch.ranks = [self.ranks[i] for i in index.tolist()]
+        batch.images = self.images
+        batch.step_rate = self.step_rate
+
+        for name in EnemyBatch.ARRAYS:
+            setattr(batch, name, getattr(self, name)[index])
+
+        return batch
+
+    def merge(self, batch, index):
+        for name in EnemyBatch.ARRAYS:
+            getattr(self, name)[index] = getattr(batch, name)
+
+        for j, i in enumerate(index.tolist()):
+            self.sprites[i] = batch.sprites[j]
+
+    def update(self, level, region, awake_region=None):
+        '''
+        Updates every enemy in the batch, or only the ones overlapping
+        awake_region if there is one. Afterwards only the sprites of
+        enemies inside region are up to date and in the entity hash.
+        When enemies bump into each other every enemy with a sprite is
+        kept up to date, and turning around waits for bump.
+        '''
+        if len(self.sprites) == 0:
+            return
+
+        if awake_region is not None:
+            awake = self.inside(awake_region)
+
+            if not awake.all():
+                index = np.nonzero(awake)[0]
+                batch = self.subset(index)
+                batch.update(level, region)
+                self.merge(batch, index)
+                return
+
+        should_reverse = np.zeros(len(self.sprites), bool)
+
+        self.vy += level.gravity
+        np.minimum(self.vy, level.terminal_velocity, out=self.vy)
+
+        self.move_x(level, should_reverse)
+
+        if self.kind is PlatformEnemy:
+            self.move_y_on_platform(level, should_reverse)
+        else:
+            self.move_y(level, should_reverse)
+
+        self.check_world_edges(level, should_reverse)
+
+        if enemies_bump:
+            near = self.live.copy()
+        else:
+            near = self.inside(region)
+
+        self.sync_rects(level, near)
+
+        if enemies_bump:
+            self.moved = self.live.copy()
+            self.turning = should_reverse
+        else:
+            self.vx[should_reverse] *= -1
+
+        self.steps = (self.steps + 1) % self.step_rate
+        stepped = self.steps == 0
+        self.walk_index[stepped] = (self.walk_index[stepped] + 1) % len(self.images)
+
+        for i in np.nonzero(near)[0].tolist():
+            self.sprites[i].image = self.images[self.walk_index[i]]
+
+# Compiled levels
+class RecordTable():
+    '''
+    RecordTables are read-only views of the tile, item or enemy records
+    in a compiled level. Iterating one gives [x, y, kind] lists just like
+    the level JSON, and array has the raw records for code that can use
+    them all at once.
+    '''
+    
+    def __init__(self, array, kinds):
+        self.array = array
+        self.kinds = kinds
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        xs = self.array['x'].tolist()
+        ys = self.array['y'].tolist()
+        kinds = self.array['kind'].tolist()
+
+        for x, y, kind in zip(xs, ys, kinds):
+            yield [x, y, self.kinds[kind]]
+
+LEVEL_MAGIC = b"PFLV"
+LEVEL_VERSION = 1
+LEVEL_HEADER = "<4sHxxII"
+
+if np is not None:
+    LEVEL_RECORD = np.dtype([('x', '<f8'), ('y', '<f8'), ('kind', '<u4'), ('pad', '<u4')])
+
+def compiled_path(path):
+    return os.path.splitext(path)[0] + ".lvl"
+
+def compile_level(path):
+    '''
+    Compiles a level's JSON into a .lvl file next to it. The file starts
+    with a header and the level's settings as JSON (everything but the
+    tiles, items and enemies, plus a table of kind names). Then comes
+    one fixed-size record per tile, item and enemy with its position and
+    the index of its kind in the table, grouped by section.
+    '''
+    if np is None:
+        raise RuntimeError("Compiling levels needs numpy")
+
+    with open(path, 'r') as f:
+        map_data = json.load(f)
+
+    meta = { key: value for key, value in map_data.items()
+             if key not in ['tiles', 'items', 'enemies'] }
+    kinds = []
+    kind_ids = {}
+    records = []
+
+    def add_records(elements):
+        start = len(records)
+
+        for element in elements:
+            kind = element[2]
+
+            if kind not in kind_ids:
+                kind_ids[kind] = len(kinds)
+                kinds.append(kind)
+
+            records.append((element[0], element[1], kind_ids[kind], 0))
+
+        return [start, len(records) - start]
+
+    meta['tiles'] = {}
+
+    for group_name in map_data['tiles']:
+        meta['tiles'][group_name] = add_records(map_data['tiles'][group_name])
+
+    meta['items'] = add_records(map_data['items'])
+    meta['enemies'] = add_records(map_data['enemies'])
+    meta['kinds'] = kinds
+
+    header = json.dumps(meta).encode('utf-8')
+    padding = -(struct.calcsize(LEVEL_HEADER) + len(header)) % LEVEL_RECORD.itemsize
+    array = np.array(records, LEVEL_RECORD)
+
+    # Written next to it first, so an interrupted compile never leaves half a file behind
+    temp_path = compiled_path(path) + ".tmp"
+
+    with open(temp_path, 'wb') as f:
+        f.write(struct.pack(LEVEL_HEADER, LEVEL_MAGIC, LEVEL_VERSION, len(header), len(records)))
+        f.write(header)
+        f.write(bytes(padding))
+        f.write(array.tobytes())
+
+    os.replace(temp_path, compiled_path(path))
+
+def load_compiled_level(path):
+    '''
+    Maps a .lvl file into memory and returns its data in the same shape
+    as level JSON, with RecordTables in place of the element lists. The
+    records are copied out in one go and the file is closed again, so
+    it can be compiled again while the game is running (Windows won't
+    replace a file that's still mapped).
+    '''
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, header_size, count = struct.unpack_from(LEVEL_HEADER, data)
+
+            if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+                raise ValueError(path + " is not a version " + str(LEVEL_VERSION) + " compiled level")
+
+            start = struct.calcsize(LEVEL_HEADER)
+            map_data = json.loads(data[start:start + header_size].decode('utf-8'))
+            start += header_size
+            start += -start % LEVEL_RECORD.itemsize
+            records = np.frombuffer(data, LEVEL_RECORD, count, start).copy()
+
+    kinds = map_data.pop('kinds')
+
+    def table(section):
+        first, size = section
+        return RecordTable(records[first:first + size], kinds)
+
+    for group_name in map_data['tiles']:
+        map_data['tiles'][group_name] = table(map_data['tiles'][group_name])
+
+    map_data['items'] = table(map_data['items'])
+    map_data['enemies'] = table(map_data['enemies'])
+
+    return map_data
+
+def load_level_data(path):
+    '''
+    Loads a level from its compiled .lvl file when there's one that's
+    at least as new as the JSON, and from the JSON otherwise (or if the
+    .lvl file is damaged or from another version).
+    '''
+    compiled = compiled_path(path)
+
+    if (np is not None and os.path.isfile(compiled) and
+        os.path.getmtime(compiled) >= os.path.getmtime(path)):
+        try:
+            return load_compiled_level(compiled)
+        except (ValueError, struct.error) as e:
+            print("Couldn't load " + compiled + " (" + str(e) + "), loading " + path + " instead")
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# Level templates are built once per level file and shared
+level_templates = {}
+level_templates_lock = threading.Lock()
+
+def get_level_template(file_path):
+    '''
+    Returns the template for a level file, building it the first time
+    and again from the last one whenever the file has changed since.
+    '''
+    with level_templates_lock:
+        template = level_templates.get(file_path)
+
+        if template is None:
+            template = LevelTemplate(file_path)
+            level_templates[file_path] = template
+        elif template.modified != os.path.getmtime(file_path):
+            template = LevelTemplate(file_path, template)
+            level_templates[file_path] = template
+
+        return template
+
+class LevelTemplate():
+    '''
+    LevelTemplates are the parts of a level that never change while it's
+    played: its settings, tiles, tile grids and prerendered layer
+    chunks (kept in chunk_cache). They're built once per level file and
+    shared by every Level loaded from it, so restarting or revisiting a
+    level doesn't parse or prerender it again.
+
+    When the file changes, the new template is built from the previous
+    one. Tile grids whose tiles didn't change are shared, and so are the
+    prerendered chunks, except for the ones the changes touched.
+    changes then counts the tiles that changed and the chunks dropped.
+    '''
+    
+    def __init__(self, file_path, previous=None):
+        self.file_path = file_path
+        self.modified = os.path.getmtime(file_path)
+        self.map_data = load_level_data(file_path)
+        self.changes = None
+        assets.warm_level(self.map_data)
+
+        self.load_layout()
+        self.load_background()
+        self.load_physics()
+
+        # Chunks from another scale don't line up, so those levels are built from scratch
+        if previous is not None and previous.scale == self.scale:
+            self.reload_tiles(previous)
+        else:
+            chunk_cache.drop(file_path)
+            self.load_tiles()
+            self.generate_layers()
+
+        self.load_goal()
+
+    def load_layout(self):
+        self.scale =  self.map_data['layout']['scale']
+        self.width =  self.map_data['layout']['size'][0] * self.scale
+        self.height = self.map_data['layout']['size'][1] * self.scale
+        self.start_x = self.map_data['layout']['start'][0] * self.scale
+        self.start_y = self.map_data['layout']['start'][1] * self.scale
+
+    def load_physics(self):
+        self.gravity = self.map_data['physics']['gravity']
+        self.terminal_velocity = self.map_data['physics']['terminal_velocity']
+
+    def load_background(self):
+        '''
+        Backgrounds can list any number of parallax layers, drawn back
+        to front. Older levels use image1/image2 with parallax_speed1
+        and parallax_speed2 instead.
+        '''
+        background = self.map_data['background']
+        self.bg_color = background['color']
+
+        if 'layers' in background:
+            layers = [[layer['image'], layer['parallax_speed']] for layer in background['layers']]
+        else:
+            layers = [[background['image1'], background['parallax_speed1']],
+                      [background['image2'], background['parallax_speed2']]]
+
+        self.parallax_layers = []
+
+        for path, speed in layers:
+            if os.path.isfile(path):
+                image = assets.image(path)
+                self.parallax_layers.append([image, speed])
+        
+
+    def load_tiles(self):
+        self.midground_grid = self.load_grid('midground')
+        self.main_grid = self.load_grid('main')
+        self.foreground_grid = self.load_grid('foreground')
+
+    def load_grid(self, group_name):
+        grid = TileGrid(self.scale)
+
+        for element in self.map_data['tiles'].get(group_name, []):
             x = element[0] * self.scale
             y = element[1] * self.scale
             kind = element[2]
-            
-            if kind == "Gem":
-                s = Gem(x, y, item_images[kind])
-                
-            self.items.add(s)
 
-    def load_enemies(self):
-        self.enemies = pygame.sprite.Group()
+            grid.add(x, y, tile_images[kind])
+
+        # Pack the cells now rather than on the first frame
+        grid.pack_cells()
+
+        return grid
+
+    def changed_tiles(self, previous, group_name):
+        '''
+        Returns the rects of the tiles in a group that were added, moved,
+        removed or changed kind since previous, or None if the group is
+        the same as before.
+        '''
+        old = previous.map_data['tiles'].get(group_name, [])
+        new = self.map_data['tiles'].get(group_name, [])
+
+        if list(old) == list(new):
+            return None
+
+        old = Counter(tuple(element) for element in old)
+        new = Counter(tuple(element) for element in new)
+        changed = (old - new) + (new - old)
+        rects = []
+
+        for x, y, kind in changed:
+            x, y = rect_position(x * self.scale, y * self.scale)
+            rects.append(pygame.Rect([x, y], tile_images[kind].get_size()))
+
+        return rects
+
+    def reload_tiles(self, previous):
+        '''
+        Takes the tile grids and chunks from the previous template, only
+        loading the grids that changed again and dropping the chunks
+        that changed tiles touch. The grid layer only changes along the
+        edges when the level is resized.
+        '''
+        midground = self.changed_tiles(previous, 'midground')
+        main = self.changed_tiles(previous, 'main')
+        foreground = self.changed_tiles(previous, 'foreground')
+
+        self.midground_grid = previous.midground_grid if midground is None else self.load_grid('midground')
+        self.main_grid = previous.main_grid if main is None else self.load_grid('main')
+        self.foreground_grid = previous.foreground_grid if foreground is None else self.load_grid('foreground')
+
+        dirty = { "inactive": (midground or []) + (main or []),
+                  "foreground": foreground or [],
+                  "grid": [] }
+
+        left, right = sorted([previous.width, self.width])
+        top, bottom = sorted([previous.height, self.height])
+
+        if left != right:
+            dirty["grid"].append(pygame.Rect(left, 0, right - left, bottom))
+        if top != bottom:
+            dirty["grid"].append(pygame.Rect(0, top, right, bottom - top))
+
+        self.generate_layers()
+        dropped = 0
+
+        for layer, rects in dirty.items():
+            for rect in rects:
+                cols, rows = self.chunk_range(rect)
+
+                for cx in cols:
+                    for cy in rows:
+                        if chunk_cache.discard((self.file_path, layer, cx, cy)):
+                            dropped += 1
+
+        self.changes = { "tiles": len(dirty["inactive"]) + len(dirty["foreground"]),
+                         "chunks": dropped }
+
+    def load_goal(self):
+        g = self.map_data['layout']['goal']
+
+        if isinstance(g, int):
+            x = g * self.scale
+            y = 0
+            w = self.width - x
+            h = self.height
+        elif isinstance(g, list):
+            x = g[0] * self.scale
+            y = g[1] * self.scale
+            w = g[2] * self.scale
+            h = g[3] * self.scale
+
+        self.goal = pygame.Rect([x, y, w, h])
+
+    def generate_layers(self):
+        self.chunk_size = chunk_tiles * self.scale
+        self.chunk_renderers = { "inactive": self.render_inactive_chunk,
+                                 "foreground": self.render_foreground_chunk,
+                                 "grid": self.render_grid_chunk }
+
+    def draw_parallax(self, surf, offset_x, offset_y):
+        '''
+        Draws each parallax layer straight onto surf. Layers repeat
+        forever, so only enough copies of the image to cover surf are
+        drawn, starting from the camera offset scaled by the layer's
+        speed and wrapped by the image size.
+        '''
+        surf_w = surf.get_width()
+        surf_h = surf.get_height()
+
+        for image, speed in self.parallax_layers:
+            img_w = image.get_width()
+            img_h = image.get_height()
+            start_x = (offset_x + int(-1 * offset_x * speed)) % img_w
+            start_y = (offset_y + int(-1 * offset_y * speed)) % img_h
+
+            if start_x > 0:
+                start_x -= img_w
+            if start_y > 0:
+                start_y -= img_h
+
+            for x in range(start_x, surf_w, img_w):
+                for y in range(start_y, surf_h, img_h):
+                    surf.blit(image, [x, y])
+
+    def draw_tiles(self, grids, rect):
+        tiles = [t for grid in grids for t in grid.collide(rect)]
+
+        if len(tiles) == 0:
+            return None
+
+        surf = pygame.Surface(rect.size, pygame.SRCALPHA, 32)
+
+        for t in tiles:
+            surf.blit(t.image, [t.rect.x - rect.x, t.rect.y - rect.y])
+
+        return surf
+
+    def render_inactive_chunk(self, rect):
+        return self.draw_tiles([self.midground_grid, self.main_grid], rect)
+
+    def render_foreground_chunk(self, rect):
+        return self.draw_tiles([self.foreground_grid], rect)
+
+    def render_grid_chunk(self, rect):
+        surf = pygame.Surface(rect.size, pygame.SRCALPHA, 32)
+        right = min(rect.right, self.width)
+        bottom = min(rect.bottom, self.height)
+
+        for x in range(rect.left, right, self.scale):
+            pygame.draw.line(surf, grid_color, [x - rect.x, 0], [x - rect.x, rect.height], 1)
+        for y in range(rect.top, bottom, self.scale):
+            pygame.draw.line(surf, grid_color, [0, y - rect.y], [right - rect.x, y - rect.y], 1)
+
+        for x in range(rect.left, right, self.scale):
+            for y in range(rect.top, bottom, self.scale):
+                coordinate = str(x // self.scale) + ", " + str(y // self.scale)
+                text = render_text(font_xs, coordinate, grid_color)
+                surf.blit(text, [x - rect.x + 4, y - rect.y + 4])
+
+        return surf
+
+    def chunk_range(self, rect):
+        cols = range(max(rect.left, 0) // self.chunk_size,
+                     (min(rect.right, self.width) - 1) // self.chunk_size + 1)
+        rows = range(max(rect.top, 0) // self.chunk_size,
+                     (min(rect.bottom, self.height) - 1) // self.chunk_size + 1)
+
+        return cols, rows
+
+    def get_chunk(self, layer, cx, cy):
+        key = (self.file_path, layer, cx, cy)
+        chunk = chunk_cache.get(key)
+
+        if chunk is False:
+            size = self.chunk_size
+            rect = pygame.Rect(cx * size, cy * size, size, size)
+            chunk = self.chunk_renderers[layer](rect)
+            chunk_cache.put(key, chunk)
+
+        return chunk
+
+    def prefetch(self, view, layers):
+        '''
+        Makes sure every chunk of layers within chunk_margin of view is
+        rendered, then trims chunk_cache back down to its budget.
+        '''
+        cols, rows = self.chunk_range(view.inflate(2 * chunk_margin, 2 * chunk_margin))
+
+        for layer in layers:
+            for cx in cols:
+                for cy in rows:
+                    self.get_chunk(layer, cx, cy)
+
+        chunk_cache.trim(len(layers) * len(cols) * len(rows))
+
+    def draw_layer(self, layer, surf, view):
+        cols, rows = self.chunk_range(view)
+
+        for cx in cols:
+            for cy in rows:
+                chunk = self.get_chunk(layer, cx, cy)
+
+                if chunk is not None:
+                    surf.blit(chunk, [cx * self.chunk_size - view.x, cy * self.chunk_size - view.y])
+
+class Level():
+    '''
+    Levels get fresh items, enemies and music every time one is loaded.
+    Everything static comes from the template for their file, which
+    also draws the background and tile layers.
+    '''
+    
+    def __init__(self, file_path):
+        self.use_template(get_level_template(file_path))
+        self.load_music()
+        records = self.element_records()
+        self.load_items(records)
+        self.load_enemies(records)
+
+    def use_template(self, template):
+        self.template = template
+        self.file_path = template.file_path
+        self.modified = template.modified
+        self.map_data = template.map_data
+        self.changes = template.changes
+
+        self.scale = template.scale
+        self.width = template.width
+        self.height = template.height
+        self.start_x = template.start_x
+        self.start_y = template.start_y
+        self.bg_color = template.bg_color
+        self.gravity = template.gravity
+        self.terminal_velocity = template.terminal_velocity
+        self.main_grid = template.main_grid
+        self.goal = template.goal
+
+    def draw_parallax(self, surf, offset_x, offset_y):
+        self.template.draw_parallax(surf, offset_x, offset_y)
+
+    def prefetch(self, view, layers):
+        self.template.prefetch(view, layers)
+
+    def draw_layer(self, layer, surf, view):
+        self.template.draw_layer(layer, surf, view)
+
+    def load_music(self):
+        self.music = self.map_data['music']
+        
+    def element_records(self):
+        '''
+        Returns a record for every item and enemy in the map data as
+        they are when the level starts, in level order.
+        '''
+        records = []
+        prototypes = {}
+
+        for rank, element in enumerate(self.map_data['items'], 1):
+            x, y = rect_position(element[0] * self.scale, element[1] * self.scale)
+            records.append([rank, element[2], x, y])
+
+        first = len(self.map_data['items']) + 1
+        
+        for rank, element in enumerate(self.map_data['enemies'], first):
+            x, y = rect_position(element[0] * self.scale, element[1] * self.scale)
+            kind = element[2]
+
+            if kind not in prototypes:
+                prototypes[kind] = enemy_kinds[kind](0, 0, enemy_images[kind])
+
+            p = prototypes[kind]
+            records.append([rank, kind, x, y, p.vx, p.vy, p.steps, p.walk_index])
+
+        return records
+
+    def load_items(self, records):
+        self.items = pygame.sprite.Group()
+        self.entity_hash = SpatialHash(self.scale)
+        self.segments = {}
+        self.live_segments = set()
+        self.spawned = []
+        
+        for record in records:
+            if record[1] not in enemy_kinds:
+                self.store(record)
+
+    def load_enemies(self, records):
+        self.enemies = pygame.sprite.Group()
+        self.enemy_batches = []
+        records = [r for r in records if r[1] in enemy_kinds]
+
+        if batch_enemies and np is not None:
+            for kind in [BasicEnemy, PlatformEnemy]:
+                kind_records = [r for r in records if r[1] == kind.__name__]
+
+                if len(kind_records) > 0:
+                    self.enemy_batches.append(EnemyBatch(kind, kind_records))
+        else:
+            for record in records:
+                self.store(record)
+
+        if stream_segment is None:
+            self.stream(None)
+
+    def segment(self, x):
+        if stream_segment is None:
+            return 0
+
+        return int(x // (stream_segment * self.scale))
+
+    def store(self, record):
+        self.segments.setdefault(self.segment(record[2]), []).append(record)
+
+    def spawn(self, record):
+        '''
+        Makes a sprite from an item or enemy record and adds it to the
+        level. Records are [order, kind, x, y], and enemies add vx, vy,
+        steps and walk_index.
+        '''
+        rank, kind, x, y = record[:4]
+
+        if kind in enemy_kinds:
+            sprite = enemy_kinds[kind](x, y, enemy_images[kind])
+            sprite.vx, sprite.vy, sprite.steps, sprite.walk_index = record[4:]
+            sprite.image = sprite.images[sprite.walk_index]
+            self.enemies.add(sprite)
+        elif kind == "Gem":
+            sprite = Gem(x, y, item_images[kind])
+            self.items.add(sprite)
+
+        sprite.order = rank
+        self.entity_hash.insert(sprite)
+        self.spawned.append(sprite)
+
+    def pack(self, sprite):
+        record = [sprite.order, type(sprite).__name__, sprite.rect.x, sprite.rect.y]
+
+        if isinstance(sprite, BasicEnemy):
+            record += [sprite.vx, sprite.vy, sprite.steps, sprite.walk_index]
+
+        return record
+
+    def despawn(self, sprite):
+        self.store(self.pack(sprite))
+        self.entity_hash.remove(sprite)
+        sprite.kill()
+
+    def stream(self, region):
+        '''
+        Turns the records in segments that region overlaps into sprites
+        and packs sprites outside of those segments back into records.
+        Batched enemies get sprites while they're in those segments. With
+        no region every record becomes a sprite. Sprites made are added to
+        spawned, in level order, so the game can pick them up.
+        '''
+        if stream_segment is None:
+            region = None
+
+        if region is None:
+            wanted = set(self.segments)
+        else:
+            # Sprites are kept by the segment their left edge is in, so the segment to the left
+            # of region is included for sprites that stick out into it
+            wanted = set(range(self.segment(region.left) - 1, self.segment(region.right - 1) + 1))
+            sprites = self.items.sprites()
+
+            if len(self.enemy_batches) == 0:
+                sprites += self.enemies.sprites()
+
+            for sprite in sprites:
+                if self.segment(sprite.rect.x) not in wanted:
+                    self.despawn(sprite)
+
+        pending = []
+
+        for segment in wanted - self.live_segments:
+            pending += [(record[0], None, record) for record in self.segments.pop(segment, [])]
+
+        for batch in self.enemy_batches:
+            pending += [(batch.ranks[i], batch, i) for i in batch.stream(self, None if region is None else wanted)]
+
+        for rank, batch, record in sorted(pending, key=lambda p: p[0]):
+            if batch is None:
+                self.spawn(record)
+            else:
+                batch.spawn(self, record)
+
+        self.live_segments = wanted
+
+    def records(self):
+        '''
+        Returns records for every item and enemy left in the level,
+        whether it's a sprite right now or not, in level order.
+        '''
+        sprites = self.items.sprites()
+
+        if len(self.enemy_batches) == 0:
+            sprites += self.enemies.sprites()
+
+        records = [self.pack(sprite) for sprite in sprites]
+
+        for batch in self.enemy_batches:
+            records += batch.records()
+
+        for segment in self.segments.values():
+            records += segment
+
+        return sorted(records, key=lambda r: r[0])
+
+    def reload(self):
+        '''
+        Picks up changes to the level file, with the tiles and layers from
+        its rebuilt template. Items and enemies are matched against the
+        ones in the old map data by position and kind. The ones still
+        there keep their state (so collected gems stay collected), ones
+        that were removed go away and new ones start fresh. Returns how
+        many items and enemies were added or removed, or None if the file
+        hasn't changed.
+        '''
+        template = get_level_template(self.file_path)
+
+        if template.modified == self.modified:
+            return None
+
+        old_elements = list(self.map_data['items']) + list(self.map_data['enemies'])
+        old_scale = self.scale
+        current = { r[0]: r for r in self.records() }
+        unmatched = {}
+
+        for rank, element in enumerate(old_elements, 1):
+            unmatched.setdefault(tuple(element), []).append(rank)
+
+        self.use_template(template)
+        self.load_music()
+
+        # Positions from another scale don't mean anything anymore, so everything starts fresh
+        if self.scale != old_scale:
+            unmatched = {}
+
+        elements = list(self.map_data['items']) + list(self.map_data['enemies'])
+        records = []
+        added = 0
+
+        for record, element in zip(self.element_records(), elements):
+            ranks = unmatched.get(tuple(element))
+
+            if ranks:
+                rank = ranks.pop(0)
+
+                if rank in current:
+                    records.append([record[0]] + current[rank][1:])
+            else:
+                records.append(record)
+                added += 1
+
+        self.load_items(records)
+        self.load_enemies(records)
+
+        return added + sum(len(ranks) for ranks in unmatched.values())
+
+    def update_batches(self, region, awake_region=None):
+        for batch in self.enemy_batches:
+            name = "update " + batch.kind.__name__
+            profiler.start(name)
+            batch.update(self, region, awake_region)
+            profiler.stop(name)
+
+    def bump_enemies(self, enemies):
+        '''
+        Checks enemies and every batched enemy that moved this step for
+        bumps, once all of them have moved.
+        '''
+        for enemy in enemies:
+            enemy.bump(self)
+
+        for batch in self.enemy_batches:
+            batch.bump(self)
+
+    def sync_batches(self):
+        for batch in self.enemy_batches:
+            batch.sync()
+
+# Frame profiling
+class Profiler():
+    '''
+    Profilers time the phases of each frame: reading input, updating
+    (also broken down by sprite type) and each stage of drawing. They
+    only measure anything while the graph is showing or the timings are
+    being saved, so an idle profiler costs next to nothing.
+    '''
+
+    PHASES = ["input", "update", "background", "layers", "sprites", "hud", "display", "wait"]
+    COLORS = { "input": (255, 255, 255),
+               "update": (230, 60, 60),
+               "background": (60, 120, 230),
+               "layers": (60, 200, 230),
+               "sprites": (240, 200, 40),
+               "hud": (200, 90, 220),
+               "display": (70, 200, 90),
+               "wait": (90, 90, 90) }
+    
+    def __init__(self, history):
+        self.history = history
+        self.visible = False
+        self.path = None
+        self.frames = []
+        self.frame = None
+        self.starts = {}
+        self.graph = pygame.Surface([history, 100])
+        self.graph.fill(BLACK)
+
+    def enabled(self):
+        return self.visible or self.path is not None
+    
+    def toggle(self):
+        self.visible = not self.visible
+
+    def record(self, path):
+        self.path = path
+
+    def begin(self):
+        if self.enabled():
+            self.frame = {}
+            self.frame_start = time.perf_counter()
+
+    def start(self, phase):
+        if self.frame is not None:
+            self.starts[phase] = time.perf_counter()
+
+    def stop(self, phase):
+        if self.frame is not None:
+            self.add(phase, time.perf_counter() - self.starts.pop(phase))
+
+    def add(self, phase, seconds):
+        self.frame[phase] = self.frame.get(phase, 0) + seconds * 1000
+
+    def end(self):
+        if self.frame is None:
+            return
+
+        self.frame["total"] = (time.perf_counter() - self.frame_start) * 1000
+        self.frames.append(self.frame)
+        self.frame = None
+
+        if self.path is None and len(self.frames) > self.history:
+            del self.frames[:-self.history]
+
+        if self.visible:
+            self.plot(self.frames[-1])
+
+    def plot(self, frame):
+        '''
+        Scrolls the graph one pixel left and draws the frame as a stacked
+        bar on the right, with the full height being two steps long.
+        '''
+        width, height = self.graph.get_size()
+        scale = height / (2000 / FPS)
+        x = width - 1
+        y = height
+
+        self.graph.scroll(-1, 0)
+        pygame.draw.line(self.graph, BLACK, [x, 0], [x, height])
         
-        for element in self.map_data['enemies']:
-            x = element[0] * self.scale
-            y = element[1] * self.scale
-            kind = element[2]
-            
-            if kind == "BasicEnemy":
-                s = BasicEnemy(x, y, basic_enemy_images)
-            elif kind == "PlatformEnemy":
-                s = PlatformEnemy(x, y, platform_enemy_images)
-                
-            self.enemies.add(s)
+        for phase in Profiler.PHASES:
+            bar = round(frame.get(phase, 0) * scale)
 
-    def load_goal(self):
-        g = self.map_data['layout']['goal']
+            if bar > 0:
+                pygame.draw.line(self.graph, Profiler.COLORS[phase], [x, y - 1], [x, y - bar])
+                y -= bar
 
-        if isinstance(g, int):
-            x = g * self.scale
-            y = 0
-            w = self.width - x
-            h = self.height
-        elif isinstance(g, list):
-            x = g[0] * self.scale
-            y = g[1] * self.scale
-            w = g[2] * self.scale
-            h = g[3] * self.scale
+        self.graph.set_at([x, height // 2], WHITE)
 
-        self.goal = pygame.Rect([x, y, w, h])
+    def draw(self, surf):
+        '''
+        Draws the graph and the average time of each phase in the top
+        right corner of surf and returns the rect it covered.
+        '''
+        recent = self.frames[-self.history:]
+        lines = []
 
-    def generate_layers(self):
-        self.world = pygame.Surface([self.width, self.height])
-        self.background1 = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.background2 = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.inactive = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.active = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.foreground = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-
-    def tile_image(self, img, surf):
-        surf_w = surf.get_width()
-        surf_h = surf.get_height()
-        img_w = self.bg_image1.get_width()
-        img_h = self.bg_image1.get_height()
-        
-        for x in range(0, surf_w, img_w):
-            for y in range(0, surf_h, img_h):
-                surf.blit(img, [x, y])
-                
-    def prerender_inactive_layers(self):
-        self.world.fill(self.bg_color)
-        
-        if self.bg_image1 != None:
-            self.tile_image(self.bg_image1, self.background1)
-            
-        if self.bg_image2 != None:
-            self.tile_image(self.bg_image2, self.background2)
-                    
-        self.midground_tiles.draw(self.inactive)
-        self.main_tiles.draw(self.inactive)        
-        self.foreground_tiles.draw(self.foreground)
-
-    def make_grid_layer(self):
-        self.grid = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
+        for phase in ["total"] + Profiler.PHASES:
+            average = sum(f.get(phase, 0) for f in recent) / max(len(recent), 1)
+            color = Profiler.COLORS.get(phase, WHITE)
+            lines.append(render_text(font_xs, "{} {:.1f} ms".format(phase, average), color))
+
+        line_height = lines[0].get_height()
+        rect = pygame.Rect(0, 0, self.history + 130, max(self.graph.get_height(), line_height * len(lines)) + 8)
+        rect.topright = surf.get_rect().topright
+        surf.fill(BLACK, rect)
+        surf.blit(self.graph, [rect.x + 4, rect.y + 4])
+
+        for i, line in enumerate(lines):
+            surf.blit(line, [rect.x + self.history + 8, rect.y + 4 + i * line_height])
+
+        return rect
+
+    def columns(self):
+        names = set()
+
+        for frame in self.frames:
+            names.update(frame)
+
+        phases = ["total"] + Profiler.PHASES
+        return phases + sorted(names - set(phases))
+
+    def save(self):
+        '''
+        Saves the timings of every recorded frame in milliseconds, as
+        JSON if the path ends in .json and as CSV otherwise.
+        '''
+        columns = self.columns()
+
+        with open(self.path, 'w', newline='') as f:
+            if self.path.endswith(".json"):
+                json.dump({ "columns": columns, "frames": self.frames }, f)
+            else:
+                writer = csv.writer(f)
+                writer.writerow(["frame"] + columns)
+
+                for i, frame in enumerate(self.frames):
+                    writer.writerow([i] + ["{:.3f}".format(frame.get(c, 0)) for c in columns])
+
+profiler = Profiler(profile_history)
+
+# Frame capture
+class FrameCapture():
+    '''
+    FrameCaptures copy each frame straight out of the screen's pixel
+    buffer into one of a fixed set of buffers, and a worker thread
+    writes them to disk. Nothing is converted or allocated per frame on
+    the game's thread. When every buffer is still waiting to be written,
+    the frame is dropped (and counted) unless drop is False, in which
+    case add waits for a buffer to be free. If writing fails, capturing
+    stops and close reports the error.
+    '''
+    
+    def __init__(self, path, surf, buffers=capture_buffers, drop=capture_drop):
+        self.path = path
+        self.drop = drop
+        self.size = surf.get_size()
+        self.canvas = surf.copy()
+        self.added = 0
+        self.dropped = 0
+        self.written = 0
+        self.error = None
+
+        folder = os.path.dirname(path)
+
+        if folder and not os.path.isdir(folder):
+            raise FileNotFoundError("Capture folder doesn't exist: " + folder)
+
+        frame_bytes = surf.get_pitch() * surf.get_height()
+        self.free = queue.Queue()
+        self.frames = queue.Queue()
+
+        for i in range(buffers):
+            self.free.put(bytearray(frame_bytes))
+
+        if "%" in path:
+            self.file = None
+        else:
+            self.file = open(path, 'wb')
+
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def add(self, surf, count=1):
+        '''
+        Captures what's on surf as the next count frames. Does nothing
+        once the writer has stopped.
+        '''
+        for i in range(count):
+            if self.error is not None or not self.thread.is_alive():
+                return
+
+            try:
+                buffer = self.free.get(block=not self.drop)
+            except queue.Empty:
+                self.dropped += 1
+                continue
+
+            view = memoryview(surf.get_view("0"))
+            buffer[:] = view
+            view.release()
+
+            self.frames.put(buffer)
+            self.added += 1
+
+    def write(self):
+        while True:
+            buffer = self.frames.get()
+
+            if buffer is None:
+                break
+
+            try:
+                if self.file is not None:
+                    self.file.write(buffer)
+                else:
+                    view = memoryview(self.canvas.get_view("0"))
+                    view[:] = buffer
+                    view.release()
+                    pygame.image.save(self.canvas, self.path % self.written)
+            except Exception as e:
+                # Hand the buffer back so an add waiting for one wakes up
+                self.error = e
+                self.free.put(buffer)
+                break
+
+            self.written += 1
+            self.free.put(buffer)
+
+    def pixel_format(self):
+        '''
+        Returns the layout of raw frames as an ffmpeg pixel format, like
+        bgr0, or None if it isn't 32 bit.
+        '''
+        if self.canvas.get_bytesize() != 4:
+            return None
+
+        names = ""
+        masks = self.canvas.get_masks()
+
+        for i in range(4):
+            byte = 0xff << (8 * i)
+            names += { masks[0]: "r", masks[1]: "g", masks[2]: "b", masks[3]: "a" }.get(byte, "0")
+
+        if sys.byteorder == "big":
+            names = names[::-1]
+
+        return names
+
+    def close(self):
+        '''
+        Waits for every captured frame to be written and returns a line
+        saying what was saved.
+        '''
+        self.frames.put(None)
+        self.thread.join()
+
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError as e:
+                self.error = self.error or e
+
+        message = "Captured {} frames to {} ({} dropped)".format(self.written, self.path, self.dropped)
+        pixel_format = self.pixel_format()
+
+        if self.error is not None:
+            return message + "\nCapture stopped, couldn't write frame {}: {}".format(self.written, self.error)
+
+        if self.file is not None and pixel_format is not None:
+            width = self.canvas.get_pitch() // 4
+            message += ("\nEncode with: ffmpeg -f rawvideo -pixel_format {} -video_size {}x{} "
+                        "-framerate {} -i {} video.mp4").format(pixel_format, width, self.size[1], FPS, self.path)
+
+        return message
+
+# Background level loading
+class LevelLoader():
+    '''
+    LevelLoaders build a Level on a worker thread, so the next level can
+    load while the "Level cleared" screen is showing. prepare is called
+    with the level on the worker thread once it's built, for any extra
+    work like prerendering chunks.
+    '''
+    
+    def __init__(self, path, prepare=None):
+        self.path = path
+        self.prepare = prepare
+        self.level = None
+        self.error = None
+        self.thread = threading.Thread(target=self.load, daemon=True)
+        self.thread.start()
+
+    def load(self):
+        try:
+            level = Level(self.path)
+
+            if self.prepare is not None:
+                self.prepare(level)
+
+            self.level = level
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        '''
+        Returns the loaded level, waiting for it if it isn't done yet.
+        Returns None if loading failed, so the level can be loaded again
+        the usual way and report the error there.
+        '''
+        self.thread.join()
+
+        return self.level
+
+# Input recording
+class Replay():
+    '''
+    Replays hold the controls (left, right and jump) for every step
+    of a game along with the levels it was played on. Since physics
+    only depends on these controls, playing them back through
+    Game.step reproduces a run exactly.
+
+    On disk a replay is a header followed by one byte per run of
+    identical steps. The low 3 bits are the controls and the high 5
+    bits are the run length minus one, so holding a direction for a
+    second takes one or two bytes. The header has the levels and a
+    hash of each level file as it was when recording started, so a
+    replay isn't played on levels that have been edited since.
+    '''
+
+    MAGIC = b"PFRP"
+    VERSION = 2
+    LEFT = 1
+    RIGHT = 2
+    JUMP = 4
+    
+    def __init__(self, levels, steps=None, hashes=None):
+        self.levels = levels
+        self.steps = bytearray() if steps is None else steps
+        self.hashes = [level_hash(path) for path in levels] if hashes is None else hashes
+
+    def __len__(self):
+        return len(self.steps)
+
+    def record(self, left, right, jump):
+        bits = 0
+
+        if left:
+            bits |= Replay.LEFT
+        if right:
+            bits |= Replay.RIGHT
+        if jump:
+            bits |= Replay.JUMP
+
+        self.steps.append(bits)
+
+    def controls(self, frame):
+        if frame < len(self.steps):
+            bits = self.steps[frame]
+            return bool(bits & Replay.LEFT), bool(bits & Replay.RIGHT), bool(bits & Replay.JUMP)
         
-        for x in range(0, self.width, self.scale):
-            pygame.draw.line(self.grid, grid_color, [x,0], [x, self.height], 1)
-        for y in range(0, self.width, self.scale):
-            pygame.draw.line(self.grid, grid_color, [0, y], [self.width, y], 1)
-            
-        for x in range(0, self.width, self.scale):
-            for y in range(0, self.width, self.scale):
-                coordinate = str(x // self.scale) + ", " + str(y // self.scale)
-                text = font_xs.render(coordinate, 1, grid_color)
-                self.grid.blit(text, [x + 4, y + 4])     
+        return False, False, False
+
+    def save(self, path):
+        runs = bytearray()
+        i = 0
+
+        while i < len(self.steps):
+            bits = self.steps[i]
+            n = 1
+
+            while n < 32 and i + n < len(self.steps) and self.steps[i + n] == bits:
+                n += 1
+
+            runs.append(bits | (n - 1) << 3)
+            i += n
+
+        header = json.dumps({ "levels": self.levels, "hashes": self.hashes }).encode("utf-8")
+
+        with open(path, 'wb') as f:
+            f.write(struct.pack("<4sBIH", Replay.MAGIC, Replay.VERSION, len(self.steps), len(header)))
+            f.write(header)
+            f.write(runs)
+
+def level_hash(path):
+    '''
+    Returns a hash of a level file's contents, or None if it's missing.
+    '''
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def load_replay(path, check_levels=True):
+    '''
+    Loads a replay saved with Replay.save. A replay recorded on levels
+    that have changed since wouldn't play out the same, so that raises
+    a ValueError unless check_levels is False. Version 1 replays don't
+    have level hashes, so their levels can't be checked.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, version, count, header_size = struct.unpack_from("<4sBIH", data)
+
+    if magic != Replay.MAGIC or version not in [1, Replay.VERSION]:
+        raise ValueError(path + " is not a version 1 to " + str(Replay.VERSION) + " replay")
+
+    start = struct.calcsize("<4sBIH")
+    header = json.loads(data[start:start + header_size].decode("utf-8"))
+
+    if version == 1:
+        levels = header
+        hashes = [None] * len(levels)
+    else:
+        levels = header["levels"]
+        hashes = header["hashes"]
+
+    if check_levels and version > 1:
+        changed = [level for level, h in zip(levels, hashes) if level_hash(level) != h]
+
+        if len(changed) > 0:
+            raise ValueError(path + " was recorded on different versions of " + ", ".join(sorted(set(changed))))
+
+    steps = bytearray()
+
+    for run in data[start + header_size:]:
+        steps.extend([run & 7] * ((run >> 3) + 1))
+
+    if len(steps) != count:
+        raise ValueError(path + " is truncated")
+
+    return Replay(levels, steps, hashes)
 
 # Main game class
 class Game():
@@ -577,12 +2752,28 @@ class Game():
         self.running = True
         self.levels = levels
         self.level_change_delay = 90
+        self.frame = 0
+
+        self.recording = None
+        self.replay = None
+        self.capture = None
+        self.next_level = None
+        self.watching = False
+        self.watch_checked = 0
+        self.watch_failed = None
+
+        self.last_render_state = None
+        self.last_sprite_rects = {}
+        self.last_positions = {}
     
     def setup(self):
         self.hero = Hero(hero_images)
         self.player = pygame.sprite.GroupSingle()
         self.player.add(self.hero)
 
+        # Sprites near the camera are updated and drawn in level order, hero first
+        self.hero.order = 0
+
         self.stage = Game.START
         self.current_level = 1
         self.load_level()
@@ -590,16 +2781,124 @@ class Game():
     def load_level(self):
         level_index = self.current_level - 1
         level_data = self.levels[level_index] 
-        self.level = Level(level_data) 
+        self.level = None
+
+        if self.next_level is not None and self.next_level.path == level_data:
+            self.level = self.next_level.result()
+
+        self.next_level = None
+
+        if self.level is None:
+            self.level = Level(level_data) 
 
         self.hero.move_to(self.level.start_x, self.level.start_y)
         self.hero.reached_goal = False
+        self.add_level_sprites()
+
+    def add_level_sprites(self):
+        '''
+        Sets up the sprite groups for the level with the hero wherever
+        it is, and makes the sprites near the camera.
+        '''
+        self.level.entity_hash.insert(self.hero)
 
         self.active_sprites = pygame.sprite.Group()
-        self.active_sprites.add(self.hero, self.level.items, self.level.enemies)
+        self.active_sprites.add(self.hero)
+
+        # The hero is updated on its own, so it's never left out by a stale spot in the entity hash
+        self.update_sprites = pygame.sprite.Group()
+
+        self.level.stream(self.activation_region(activation_margin))
+        self.add_spawned()
+
+        self.last_positions = {}
+
+    def add_spawned(self):
+        '''
+        Adds the sprites the level has made since last time to the
+        game's groups.
+        '''
+        for sprite in self.level.spawned:
+            self.active_sprites.add(sprite)
+
+            # Batched enemies are updated by the level instead of one at a time
+            if not isinstance(sprite, BasicEnemy) or len(self.level.enemy_batches) == 0:
+                self.update_sprites.add(sprite)
+
+        self.level.spawned = []
+
+    def watch_level(self):
+        '''
+        Reloads the level if its file has changed, keeping the hero where
+        it is. The file is checked at most every watch_interval seconds.
+        '''
+        now = time.perf_counter()
+
+        if now - self.watch_checked < watch_interval:
+            return
+
+        self.watch_checked = now
+        path = self.level.file_path
+
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            return
+
+        if modified == self.level.modified or modified == self.watch_failed:
+            return
+
+        # A half saved or broken file shouldn't end the game, so the old level is kept until it's fixed
+        try:
+            music = self.level.music
+            changed = self.level.reload()
+        except Exception as e:
+            self.watch_failed = modified
+            print("Couldn't reload " + path + ": " + str(e))
+            return
+
+        if changed is None:
+            return
+
+        # The next level might be this one again, loaded from before the change
+        if self.next_level is not None and self.next_level.path == path:
+            self.next_level.result()
+            self.next_level = None
+
+        self.add_level_sprites()
+        self.last_render_state = None
+
+        if self.stage == Game.PLAYING and self.level.music != music:
+            audio.play_music(self.level.music)
+
+        if self.level.changes is None:
+            summary = "rebuilt everything"
+        else:
+            summary = "{} tiles changed, {} chunks to prerender".format(self.level.changes["tiles"],
+                                                                       self.level.changes["chunks"])
+
+        print("Reloaded {} in {:.1f} ms: {}, {} items and enemies changed".format(
+              path, (time.perf_counter() - now) * 1000, summary, changed))
+
+    def prefetch_next_level(self):
+        '''
+        Starts loading the level after this one in the background, along
+        with the layer chunks around where the camera will start and its
+        music.
+        '''
+        if self.current_level < len(self.levels):
+            hero_size = self.hero.rect.size
+            layers = self.layer_names()
+
+            def prepare(level):
+                hero_rect = pygame.Rect([level.start_x, level.start_y], hero_size)
+                level.prefetch(self.camera_rect(hero_rect, level), layers)
+                audio.preload_music(level.music)
+
+            self.next_level = LevelLoader(self.levels[self.current_level], prepare)
 
     def start_level(self):
-        play_music()
+        audio.play_music(self.level.music)
         self.stage = Game.PLAYING
             
     def advance(self):
@@ -611,34 +2910,34 @@ class Game():
             self.stage = Game.WIN
 
     def show_title_screen(self):
-        text = font_xl.render(TITLE, 1, BLACK)
+        text = render_text(font_xl, TITLE, BLACK)
         rect = text.get_rect()
         rect.centerx = SCREEN_WIDTH // 2
         rect.centery = 212
         screen.blit(text, rect)
         
-        text = font_sm.render("Press space to start.", 1, BLACK)
+        text = render_text(font_sm, "Press space to start.", BLACK)
         rect = text.get_rect()
         rect.centerx = SCREEN_WIDTH // 2
         rect.centery = 272
         screen.blit(text, rect)
         
     def show_cleared_screen(self):
-        text = font_lg.render("Level cleared", 1, BLACK)
+        text = render_text(font_lg, "Level cleared", BLACK)
         rect = text.get_rect()
         rect.centerx = SCREEN_WIDTH // 2
         rect.centery = 144
         screen.blit(text, rect)
 
     def show_win_screen(self):
-        text = font_lg.render("You win", 1, BLACK)
+        text = render_text(font_lg, "You win", BLACK)
         rect = text.get_rect()
         rect.centerx = SCREEN_WIDTH // 2
         rect.centery = 144
         screen.blit(text, rect)
 
     def show_lose_screen(self):
-        text = font_lg.render("You lose", 1, BLACK)
+        text = render_text(font_lg, "You lose", BLACK)
         rect = text.get_rect()
         rect.centerx = SCREEN_WIDTH // 2
         rect.centery = 144
@@ -647,7 +2946,7 @@ class Game():
     def show_stats(self):
         level_str = "L: " + str(self.current_level)
         
-        text = font_md.render(level_str, 1, BLACK)
+        text = render_text(font_md, level_str, BLACK)
         rect = text.get_rect()
         rect.left = 24
         rect.top = 24
@@ -655,7 +2954,7 @@ class Game():
     
         score_str = "S: " + str(self.hero.score)
         
-        text = font_md.render(score_str, 1, BLACK)
+        text = render_text(font_md, score_str, BLACK)
         rect = text.get_rect()
         rect.right = SCREEN_WIDTH - 24
         rect.top = 24
@@ -663,62 +2962,207 @@ class Game():
         
         score_str = "H: " + str(self.hero.hearts)
         
-        text = font_md.render(score_str, 1, BLACK)
+        text = render_text(font_md, score_str, BLACK)
         rect = text.get_rect()
         rect.left = 24
         rect.top = 64
         screen.blit(text, rect)          
                    
-    def calculate_offset(self):
-        x = -1 * self.hero.rect.centerx + SCREEN_WIDTH / 2
+    def calculate_offset(self, hero_rect=None, level=None):
+        if hero_rect is None:
+            hero_rect = self.hero.rect
+        if level is None:
+            level = self.level
+
+        x = -1 * hero_rect.centerx + SCREEN_WIDTH / 2
         y = 0
         
-        if self.hero.rect.centerx < SCREEN_WIDTH / 2:
+        if hero_rect.centerx < SCREEN_WIDTH / 2:
             x = 0
-        elif self.hero.rect.centerx > self.level.width - SCREEN_WIDTH / 2:
-            x = -1 * self.level.width + SCREEN_WIDTH
+        elif hero_rect.centerx > level.width - SCREEN_WIDTH / 2:
+            x = -1 * level.width + SCREEN_WIDTH
 
         return round(x), round(y)
 
+    def camera_rect(self, hero_rect=None, level=None):
+        offset_x, offset_y = self.calculate_offset(hero_rect, level)
+
+        return pygame.Rect(-offset_x, -offset_y, SCREEN_WIDTH, SCREEN_HEIGHT)
+
+    def activation_region(self, margin):
+        '''
+        Returns the part of the level within margin pixels of the camera,
+        or None when every sprite is kept awake.
+        '''
+        if activation_margin is None:
+            return None
+
+        return self.camera_rect().inflate(2 * margin, 2 * margin)
+
+    def nearby_sprites(self, group, region):
+        '''
+        Returns the sprites in group overlapping region in level order,
+        looked up in the entity hash, or all of them if region is None.
+        '''
+        if region is None:
+            return group.sprites()
+
+        sprites = [s for s in self.level.entity_hash.query(region) if group.has(s)]
+
+        return sorted(sprites, key=lambda s: s.order)
+
     def process_input(self):     
+        '''
+        Reads the keyboard and returns the controls for the next step
+        as (left, right, jump).
+        '''
+        jump = False
+
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 self.running = False
                 
             elif event.type == pygame.KEYDOWN:
-                if self.stage == Game.START:
-                    if event.key == pygame.K_SPACE:
-                        self.start_level()
-                        
-                elif self.stage == Game.PLAYING:
-                    if event.key == pygame.K_SPACE:
-                        self.hero.jump(self.level.main_tiles)
-
-                elif self.stage == Game.WIN or self.stage == Game.LOSE:
-                    if event.key == pygame.K_SPACE:
-                        self.setup()
+                if event.key == pygame.K_SPACE:
+                    jump = True
+                elif event.key == profile_key:
+                    profiler.toggle()
 
         pressed = pygame.key.get_pressed()
+
+        return pressed[pygame.K_LEFT], pressed[pygame.K_RIGHT], jump
+
+    def apply_controls(self, left, right, jump):
+        '''
+        left and right are True while those keys are held down. jump is
+        True on frames where space was pressed.
+        '''
+        if jump:
+            if self.stage == Game.START:
+                self.start_level()
+                        
+            elif self.stage == Game.PLAYING:
+                self.hero.jump(self.level)
+
+            elif self.stage == Game.WIN or self.stage == Game.LOSE:
+                self.setup()
         
         if self.stage == Game.PLAYING:
-            if pressed[pygame.K_LEFT]:
+            if left:
                 self.hero.move_left()
-            elif pressed[pygame.K_RIGHT]:
+            elif right:
                 self.hero.move_right()
             else:
                 self.hero.stop()
+
+    def step(self, left=False, right=False, jump=False):
+        '''
+        Advances the game one frame with the given controls, without
+        reading the keyboard or rendering. While a replay is playing,
+        its controls are used instead.
+        '''
+        audio.new_step()
+
+        if self.replay is not None:
+            left, right, jump = self.replay.controls(self.frame)
+
+        if self.recording is not None:
+            self.recording.record(left, right, jump)
+
+        profiler.start("update")
+        self.apply_controls(left, right, jump)
+        self.update()
+        profiler.stop("update")
+        self.frame += 1
+
+    def simulate(self, frames, inputs=None):
+        '''
+        Steps the game frames times as fast as possible and returns the
+        resulting state. inputs can be a list of (left, right, jump)
+        tuples, one per frame, or a function that takes the frame number
+        and returns one. Frames without an input have no keys pressed.
+        '''
+        for i in range(frames):
+            if callable(inputs):
+                controls = inputs(self.frame)
+            elif inputs is not None and i < len(inputs):
+                controls = inputs[i]
+            else:
+                controls = (False, False, False)
+
+            profiler.begin()
+            self.step(*controls)
+            profiler.end()
+
+        return self.state()
+
+    def state(self):
+        self.level.sync_batches()
+
+        hero = { "x": self.hero.rect.x,
+                 "y": self.hero.rect.y,
+                 "vx": self.hero.vx,
+                 "vy": self.hero.vy,
+                 "score": self.hero.score,
+                 "hearts": self.hero.hearts }
+
+        # Records cover streamed out items and enemies too
+        records = self.level.records()
+        items = [r[1:4] for r in records if r[1] not in enemy_kinds]
+        enemies = [r[1:6] for r in records if r[1] in enemy_kinds]
+
+        return { "frame": self.frame,
+                 "stage": self.stage,
+                 "level": self.current_level,
+                 "hero": hero,
+                 "items": items,
+                 "enemies": enemies }
      
     def update(self):
         if self.stage == Game.PLAYING:
-            self.active_sprites.update(self.level)
+            self.level.stream(self.activation_region(activation_margin))
+            self.add_spawned()
+
+            awake_region = self.activation_region(activation_margin)
+            coarse = sleep_interval > 0 and self.frame % sleep_interval == 0
+
+            # Streamed out sprites are only records, but batched enemies keep their arrays
+            if coarse:
+                batch_awake_region = None
+            else:
+                batch_awake_region = awake_region
+
+            if coarse and stream_segment is None:
+                awake_region = None
+
+            sprites = [self.hero] + self.nearby_sprites(self.update_sprites, awake_region)
+
+            if profiler.frame is None:
+                for sprite in sprites:
+                    sprite.update(self.level)
+            else:
+                for sprite in sprites:
+                    name = "update " + type(sprite).__name__
+                    profiler.start(name)
+                    sprite.update(self.level)
+                    profiler.stop(name)
+
+            # Enemies near the camera are kept in sync since they can be seen or touch the hero
+            region = self.camera_rect().inflate(SCREEN_WIDTH, SCREEN_HEIGHT)
+            self.level.update_batches(region, batch_awake_region)
+
+            if enemies_bump:
+                self.level.bump_enemies([s for s in sprites if isinstance(s, BasicEnemy)])
+            self.add_spawned()
 
             if self.hero.reached_goal:
-                stop_music()
+                audio.stop_music()
                 self.stage = Game.CLEARED
                 self.cleared_timer = self.level_change_delay
+                self.prefetch_next_level()
             elif self.hero.hearts == 0:
                 self.stage = Game.LOSE
-                stop_music()
+                audio.stop_music()
                 
         elif self.stage == Game.CLEARED:
             self.cleared_timer -= 1
@@ -726,27 +3170,121 @@ class Game():
             if self.cleared_timer == 0:
                 self.advance()
             
-    def render(self):
-        self.level.active.fill([0, 0, 0, 0])
-        self.active_sprites.draw(self.level.active)
-
-        offset_x, offset_y = self.calculate_offset()
-        bg1_offset_x = -1 * offset_x * self.level.parallax_speed1
-        bg1_offset_y = -1 * offset_y * self.level.parallax_speed1
-        bg2_offset_x = -1 * offset_x * self.level.parallax_speed2
-        bg2_offset_y = -1 * offset_y * self.level.parallax_speed2
-        
-        self.level.world.blit(self.level.background1, [bg1_offset_x, bg1_offset_y])
-        self.level.world.blit(self.level.background2, [bg2_offset_x, bg2_offset_y])
-        self.level.world.blit(self.level.inactive, [0, 0])
-        self.level.world.blit(self.level.active, [0, 0])
-        self.level.world.blit(self.level.foreground, [0, 0])
-
+    def layer_names(self):
         if show_grid:
-            self.level.world.blit(self.level.grid, [0, 0])                     
+            return ["inactive", "foreground", "grid"]
+        else:
+            return ["inactive", "foreground"]
 
-        screen.blit(self.level.world, [offset_x, offset_y])
+    def save_positions(self):
+        self.last_positions = {}
+        region = self.activation_region(SCREEN_WIDTH // 2)
 
+        for sprite in self.nearby_sprites(self.active_sprites, region):
+            self.last_positions[sprite] = sprite.rect.topleft
+
+    def interpolate(self, sprite, alpha):
+        '''
+        Returns sprite's rect moved alpha of the way from where it was
+        before the last step to where it is now. Sprites that weren't
+        around before the last step (like after a level loads) are
+        just drawn where they are.
+        '''
+        last = self.last_positions.get(sprite)
+
+        if last is None or alpha >= 1:
+            return sprite.rect
+
+        x = round(last[0] + (sprite.rect.x - last[0]) * alpha)
+        y = round(last[1] + (sprite.rect.y - last[1]) * alpha)
+
+        return pygame.Rect(x, y, sprite.rect.width, sprite.rect.height)
+
+    def sprite_rects(self, view, alpha):
+        '''
+        Returns where each active sprite will be drawn on the screen
+        this frame along with the image it will be drawn with. Images
+        can be bigger than a sprite's rect (like the hero's walk and
+        hurt images), so the rect covers the whole image.
+        '''
+        rects = {}
+        region = None
+
+        # Images can stick out of their rects and sprites are drawn a bit behind where they are
+        if activation_margin is not None:
+            region = view.inflate(2 * self.level.scale, 2 * self.level.scale)
+
+        for sprite in self.nearby_sprites(self.active_sprites, region):
+            rect = self.interpolate(sprite, alpha)
+            x = rect.x - view.x
+            y = rect.y - view.y
+            rects[sprite] = (sprite.image.get_rect(topleft=(x, y)), sprite.image)
+
+        return rects
+
+    def find_dirty_rects(self, sprite_rects):
+        '''
+        Finds the parts of the screen that sprites left or entered
+        since the last frame. Overlapping rects are merged so each
+        part of the screen is only redrawn once.
+        '''
+        changed = []
+        screen_rect = screen.get_rect()
+
+        for sprite, drawn in sprite_rects.items():
+            last = self.last_sprite_rects.get(sprite)
+
+            if last != drawn:
+                changed.append(drawn[0])
+
+                if last is not None:
+                    changed.append(last[0])
+
+        for sprite, last in self.last_sprite_rects.items():
+            if sprite not in sprite_rects:
+                changed.append(last[0])
+
+        dirty = []
+
+        for rect in changed:
+            rect = rect.clip(screen_rect)
+
+            if rect.width > 0 and rect.height > 0:
+                i = rect.collidelist(dirty)
+
+                while i != -1:
+                    rect.union_ip(dirty.pop(i))
+                    i = rect.collidelist(dirty)
+
+                dirty.append(rect)
+
+        return dirty
+
+    def compose(self, view, sprite_rects, clip=None):
+        # Only the part of each layer inside the camera view is copied to the screen
+        profiler.start("background")
+        screen.fill(self.level.bg_color)
+        self.level.draw_parallax(screen, -view.x, -view.y)
+        profiler.stop("background")
+
+        profiler.start("layers")
+        self.level.draw_layer("inactive", screen, view)
+        profiler.stop("layers")
+
+        profiler.start("sprites")
+        for rect, image in sprite_rects.values():
+            if clip is None or rect.colliderect(clip):
+                screen.blit(image, rect)
+        profiler.stop("sprites")
+
+        profiler.start("layers")
+        self.level.draw_layer("foreground", screen, view)
+
+        if show_grid:
+            self.level.draw_layer("grid", screen, view)
+        profiler.stop("layers")
+
+        profiler.start("hud")
         self.show_stats()
         
         if self.stage == Game.START:
@@ -757,22 +3295,199 @@ class Game():
             self.show_win_screen()
         elif self.stage == Game.LOSE:
             self.show_lose_screen()
+        profiler.stop("hud")
 
-        pygame.display.flip()
+    def render(self, alpha=1.0):
+        '''
+        Draws the current frame. alpha is how far along the time between
+        the last step and the next one this frame is drawn at.
+        '''
+        view = self.camera_rect(self.interpolate(self.hero, alpha))
+        sprite_rects = self.sprite_rects(view, alpha)
+
+        self.level.prefetch(view, self.layer_names())
+
+        # Anything besides sprites moving around means the whole screen has to be redrawn
+        render_state = (self.level, view.topleft, self.stage, self.current_level,
+                        self.hero.score, self.hero.hearts, show_grid, profiler.visible)
+
+        if dirty_rects and render_state == self.last_render_state:
+            dirty = self.find_dirty_rects(sprite_rects)
+
+            for rect in dirty:
+                screen.set_clip(rect)
+                self.compose(view, sprite_rects, rect)
+
+            screen.set_clip(None)
+
+            # The graph changes every frame, so it's always redrawn
+            if profiler.visible:
+                dirty.append(profiler.draw(screen))
+
+            profiler.start("display")
+            if len(dirty) > 0:
+                pygame.display.update(dirty)
+            profiler.stop("display")
+        else:
+            self.compose(view, sprite_rects)
+
+            if profiler.visible:
+                profiler.draw(screen)
+
+            profiler.start("display")
+            pygame.display.flip()
+            profiler.stop("display")
+
+        self.last_render_state = render_state
+        self.last_sprite_rects = sprite_rects
             
-    def run(self):        
+    def run(self, frames=FPS * 60):
+        '''
+        Plays the game until it's quit. Headless there's no window to
+        close, so it stops after frames steps instead. Game.simulate
+        does the same with scripted controls.
+        '''
+        if headless:
+            for i in range(frames):
+                if not self.running:
+                    break
+
+                profiler.begin()
+                profiler.start("input")
+                controls = self.process_input()
+                profiler.stop("input")
+                self.step(*controls)
+                profiler.end()
+
+            return
+
+        step_time = 1 / FPS
+        lag = 0
+        jump = False
+        self.clock.tick()
+
         while self.running:
-            self.process_input()
-            self.update()
-            self.render()
-            self.clock.tick(FPS)
+            profiler.begin()
+            profiler.start("wait")
+            lag += self.clock.tick(RENDER_FPS) / 1000
+            profiler.stop("wait")
+
+            profiler.start("input")
+            left, right, pressed_jump = self.process_input()
+            profiler.stop("input")
+            jump = jump or pressed_jump
+
+            if self.watching:
+                profiler.start("reload")
+                self.watch_level()
+                profiler.stop("reload")
+
+            steps = 0
+
+            while lag >= step_time and steps < MAX_CATCHUP_STEPS:
+                self.save_positions()
+                self.step(left, right, jump)
+                jump = False
+                lag -= step_time
+                steps += 1
+
+            if lag >= step_time:
+                lag = lag % step_time
+
+            self.render(lag / step_time)
+
+            # Videos need a frame for every step, even ones that weren't drawn on their own
+            if self.capture is not None and steps > 0:
+                profiler.start("capture")
+                self.capture.add(screen, steps)
+                profiler.stop("capture")
+
+            profiler.end()
 
             
 # Let's do this!
 if __name__ == "__main__":
-    g = Game(levels)
+    parser = argparse.ArgumentParser(description=TITLE)
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a window or sound and print the final state")
+    parser.add_argument("--frames", type=int, default=FPS * 60,
+                        help="number of frames to simulate in headless mode")
+    parser.add_argument("--record", metavar="FILE",
+                        help="save the controls for every frame to FILE")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="play back controls saved with --record")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="save how long each phase of every frame took to FILE (.csv or .json)")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="save a frame for every step as raw pixels, or as PNGs if FILE has a %% in it")
+    parser.add_argument("--watch", action="store_true",
+                        help="reload the current level whenever its file changes")
+    parser.add_argument("--compile-levels", metavar="FILE", nargs="*",
+                        help="compile level JSON (all of assets/levels by default) into .lvl files")
+    args = parser.parse_args()
+
+    if args.capture and headless:
+        parser.error("--capture needs frames to be drawn, so it can't be used with --headless")
+
+    if args.watch and headless:
+        parser.error("--watch reloads levels while playing, so it can't be used with --headless")
+
+    if args.compile_levels is not None and np is None:
+        parser.error("--compile-levels needs numpy, which isn't installed")
+
+    if args.compile_levels is not None:
+        for path in args.compile_levels or sorted(glob.glob("assets/levels/*.json")):
+            compile_level(path)
+            print("Compiled " + path + " to " + compiled_path(path))
+
+        pygame.quit()
+        sys.exit()
+
+    if sleep_interval > 0 and stream_segment is not None and activation_margin is not None:
+        print("sleep_interval only updates sleeping batched enemies while levels are streamed", file=sys.stderr)
+
+    if args.replay:
+        try:
+            replay = load_replay(args.replay)
+        except ValueError as e:
+            parser.error(str(e))
+
+        g = Game(replay.levels)
+        g.replay = replay
+        frames = len(replay)
+    else:
+        g = Game(levels)
+        frames = args.frames
+
+    if args.record:
+        g.recording = Replay(g.levels)
+
+    if args.profile:
+        profiler.record(args.profile)
+
+    if args.capture:
+        try:
+            g.capture = FrameCapture(args.capture, screen)
+        except OSError as e:
+            parser.error(str(e))
+
+    g.watching = args.watch
+
     g.setup()
-    g.run()
+
+    if headless:
+        print(json.dumps(g.simulate(frames)))
+    else:
+        g.run()
+
+    if args.record:
+        g.recording.save(args.record)
+
+    if args.profile:
+        profiler.save()
+
+    if args.capture:
+        print(g.capture.close())
     
     pygame.quit()
     sys.exit()
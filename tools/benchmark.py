@@ -0,0 +1,196 @@
+# Measures how the game performs on generated levels of increasing size. Run
+# from the root of the project:
+#
+#     python tools/benchmark.py
+#     python tools/benchmark.py --save before.json
+#     python tools/benchmark.py --compare before.json
+#
+# Every level is played with the same scripted inputs (run right, jumping now
+# and then) without a window, and the game is timed loading it, updating and
+# drawing. Results can be saved as a baseline and compared against later runs.
+
+# Imports
+import argparse
+import importlib.util
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from generate_level import generate_level
+
+# Settings
+GAME_FILE = "platformer-final.py"
+SIZES = [50, 200, 1000, 5000]
+FRAMES = 600
+JUMP_EVERY = 40
+
+# Lots of hearts so running into enemies doesn't end a run early
+HEARTS = 1000000
+
+METRICS = [ ("load_ms", "load ms", False),
+            ("reload_ms", "reload ms", False),
+            ("update_fps", "update fps", True),
+            ("render_fps", "render fps", True),
+            ("peak_mb", "peak MB", False) ]
+
+def load_game():
+    os.environ["PLATFORMER_HEADLESS"] = "1"
+    spec = importlib.util.spec_from_file_location("platformer", GAME_FILE)
+    game = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(game)
+
+    return game
+
+def scripted_input(frame):
+    # The jump on the first frame also starts the game
+    return False, True, frame % JUMP_EVERY == 0
+
+def start_game(game, path):
+    g = game.Game([path])
+    g.setup()
+    g.hero.hearts = HEARTS
+
+    return g
+
+def time_load(game, path):
+    game.level_templates.clear()
+    start = time.perf_counter()
+    game.Level(path)
+    load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    game.Level(path)
+    reload = time.perf_counter() - start
+
+    return load * 1000, reload * 1000
+
+def time_update(game, path, frames):
+    g = start_game(game, path)
+    start = time.perf_counter()
+    g.simulate(frames, scripted_input)
+
+    return frames / (time.perf_counter() - start)
+
+def time_render(game, path, frames):
+    g = start_game(game, path)
+    elapsed = 0
+
+    for i in range(frames):
+        g.save_positions()
+        g.step(*scripted_input(g.frame))
+
+        start = time.perf_counter()
+        g.render()
+        elapsed += time.perf_counter() - start
+
+    return frames / elapsed
+
+def peak_memory(game, path, frames):
+    '''
+    Peak memory allocated by Python while loading and playing the
+    level. Surfaces are allocated by SDL, so prerendered chunks aren't
+    counted here (chunk_budget caps those).
+    '''
+    tracemalloc.start()
+    game.level_templates.clear()
+    g = start_game(game, path)
+    g.simulate(frames, scripted_input)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak / (1024 * 1024)
+
+def run_benchmark(game, width, args, folder):
+    data = generate_level(width, 9, args.density, width // 10, width // 10, args.seed)
+    path = os.path.join(folder, "bench-" + str(width) + ".json")
+
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+    if args.compile:
+        game.compile_level(path)
+
+    load_ms, reload_ms = time_load(game, path)
+
+    return { "width": width,
+             "tiles": sum(len(tiles) for tiles in data["tiles"].values()),
+             "enemies": len(data["enemies"]),
+             "load_ms": load_ms,
+             "reload_ms": reload_ms,
+             "update_fps": time_update(game, path, args.frames),
+             "render_fps": time_render(game, path, args.frames),
+             "peak_mb": peak_memory(game, path, args.frames) }
+
+def change(value, old, higher_is_better):
+    if old == 0:
+        return ""
+
+    percent = (value - old) / old * 100
+    better = percent > 0 if higher_is_better else percent < 0
+
+    return " ({:+.0f}%{})".format(percent, "" if abs(percent) < 5 else " better" if better else " worse")
+
+def report(results, baseline=None):
+    old = {}
+
+    if baseline is not None:
+        old = { r["width"]: r for r in baseline["results"] }
+
+    header = "{:>6} {:>7} {:>7}".format("width", "tiles", "enemies")
+
+    for key, name, higher_is_better in METRICS:
+        header += " {:>22}".format(name)
+
+    print(header)
+
+    for r in results:
+        line = "{:>6} {:>7} {:>7}".format(r["width"], r["tiles"], r["enemies"])
+
+        for key, name, higher_is_better in METRICS:
+            cell = "{:.1f}".format(r[key])
+
+            if r["width"] in old:
+                cell += change(r[key], old[r["width"]][key], higher_is_better)
+
+            line += " {:>22}".format(cell)
+
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the game on generated levels.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="level widths in tiles")
+    parser.add_argument("--frames", type=int, default=FRAMES, help="frames to play on each level")
+    parser.add_argument("--density", type=float, default=0.15, help="platform density of the levels")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the levels")
+    parser.add_argument("--compile", action="store_true", help="load the levels from compiled .lvl files")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with a saved baseline")
+    args = parser.parse_args()
+
+    game = load_game()
+
+    # Load the game's own first level once so the first size doesn't pay for decoding images
+    game.Level(game.levels[0])
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as folder:
+        for width in args.sizes:
+            results.append(run_benchmark(game, width, args, folder))
+
+    baseline = None
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({ "frames": args.frames, "results": results }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
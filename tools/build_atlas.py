@@ -0,0 +1,95 @@
+# Packs the character, tile and item images into a few sheets so the game
+# can load each sheet with one decode instead of loading every PNG on its
+# own. Run from the root of the project:
+#
+#     python tools/build_atlas.py
+#
+# The sheets and an index of where each image ended up are written to
+# assets/atlas. The game uses them automatically when they're there.
+
+# Imports
+import pygame
+import json
+import os
+
+# Settings
+SHEETS = { "characters": "assets/images/characters",
+           "tiles": "assets/images/tiles",
+           "items": "assets/images/items" }
+
+OUTPUT_DIR = "assets/atlas"
+INDEX_FILE = "atlas.json"
+SHEET_WIDTH = 1024
+PADDING = 1
+
+def find_images(folder):
+    paths = []
+
+    for name in sorted(os.listdir(folder)):
+        if name.lower().endswith(".png"):
+            paths.append(folder + "/" + name)
+
+    return paths
+
+def pack(sizes, sheet_width, padding):
+    '''
+    Shelf packing: images are placed left to right in rows, tallest
+    first, starting a new row whenever one is full. Returns where each
+    image goes and how tall the sheet needs to be.
+    '''
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    spots = [None] * len(sizes)
+    x = 0
+    y = 0
+    row_height = 0
+
+    for i in order:
+        w, h = sizes[i]
+
+        if x + w > sheet_width:
+            x = 0
+            y += row_height + padding
+            row_height = 0
+
+        spots[i] = [x, y]
+        x += w + padding
+        row_height = max(row_height, h)
+
+    return spots, y + row_height
+
+def build_sheet(name, paths):
+    images = [pygame.image.load(path) for path in paths]
+    sizes = [img.get_size() for img in images]
+    width = max([SHEET_WIDTH] + [w for w, h in sizes])
+    spots, height = pack(sizes, width, PADDING)
+
+    sheet = pygame.Surface([width, height], pygame.SRCALPHA, 32)
+    entries = {}
+
+    for path, img, spot in zip(paths, images, spots):
+        sheet.blit(img, spot)
+        entries[path] = [name, spot[0], spot[1], img.get_width(), img.get_height()]
+
+    file_name = name + ".png"
+    pygame.image.save(sheet, os.path.join(OUTPUT_DIR, file_name))
+
+    return file_name, entries
+
+def main():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    index = { "sheets": {}, "images": {} }
+
+    for name, folder in SHEETS.items():
+        paths = find_images(folder)
+
+        if len(paths) > 0:
+            file_name, entries = build_sheet(name, paths)
+            index["sheets"][name] = file_name
+            index["images"].update(entries)
+            print(name + ": " + str(len(paths)) + " images")
+
+    with open(os.path.join(OUTPUT_DIR, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+if __name__ == "__main__":
+    main()
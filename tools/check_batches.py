@@ -0,0 +1,123 @@
+# Checks that enemies updated in NumPy batches play out exactly like enemies
+# updated one sprite at a time. Run from the root of the project after
+# changing how enemies move:
+#
+#     python tools/check_batches.py
+#     python tools/check_batches.py --seeds 0 1 2 3 --frames 2000
+#
+# Every generated level is played twice with the same scripted inputs, once
+# with batch_enemies on and once with it off, under each combination of
+# enemies_bump, sleeping and streaming. The game states are compared after
+# every frame and the first difference is printed.
+
+# Imports
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+
+from generate_level import generate_level
+
+# Settings
+GAME_FILE = "platformer-final.py"
+WIDTH = 300
+ENEMIES = 60
+FRAMES = 1200
+JUMP_EVERY = 40
+
+# Lots of hearts so running into enemies doesn't end a run early
+HEARTS = 1000000
+
+# Game settings to change for each pair of runs
+OPTIONS = [ {},
+            { "enemies_bump": True },
+            { "activation_margin": None, "stream_segment": None },
+            { "enemies_bump": True, "activation_margin": None, "stream_segment": None },
+            { "enemies_bump": True, "stream_segment": None },
+            { "enemies_bump": True, "activation_margin": None },
+            { "enemies_bump": True, "sleep_interval": 10, "stream_segment": None } ]
+
+def load_game():
+    os.environ["PLATFORMER_HEADLESS"] = "1"
+    spec = importlib.util.spec_from_file_location("platformer", GAME_FILE)
+    game = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(game)
+
+    return game
+
+def scripted_input(frame):
+    # The jump on the first frame also starts the game
+    return False, (frame // 300) % 4 != 3, frame % JUMP_EVERY == 0
+
+def play(game, path, batched, frames):
+    game.batch_enemies = batched
+    g = game.Game([path])
+    g.setup()
+    g.hero.hearts = HEARTS
+
+    states = []
+
+    for i in range(frames):
+        g.step(*scripted_input(g.frame))
+        states.append(g.state())
+
+    return states
+
+def first_difference(a, b):
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            for key in x:
+                if x[key] != y[key]:
+                    return i, key
+
+    return None
+
+def check(path, options, frames):
+    game = load_game()
+
+    for name, value in options.items():
+        setattr(game, name, value)
+
+    if game.np is None:
+        sys.exit("Batches need numpy")
+
+    batched = play(game, path, True, frames)
+    single = play(game, path, False, frames)
+
+    return first_difference(batched, single)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that batched and unbatched enemies match.")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1], help="random seeds for the levels")
+    parser.add_argument("--frames", type=int, default=FRAMES, help="frames to play on each level")
+    parser.add_argument("--width", type=int, default=WIDTH, help="width of the levels in tiles")
+    parser.add_argument("--enemies", type=int, default=ENEMIES, help="enemies in each level")
+    args = parser.parse_args()
+
+    failed = 0
+
+    with tempfile.TemporaryDirectory() as folder:
+        for seed in args.seeds:
+            data = generate_level(args.width, 9, 0.15, args.enemies, args.width // 10, seed)
+            path = os.path.join(folder, "check-" + str(seed) + ".json")
+
+            with open(path, 'w') as f:
+                json.dump(data, f)
+
+            for options in OPTIONS:
+                difference = check(path, options, args.frames)
+                name = "seed {} {}".format(seed, " ".join("{}={}".format(*o) for o in options.items()) or "defaults")
+
+                if difference is None:
+                    print(name + ": same")
+                else:
+                    print(name + ": differs at frame {} in {}".format(*difference))
+                    failed += 1
+
+    if failed > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
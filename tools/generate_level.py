@@ -0,0 +1,121 @@
+# Writes a random level in the same format as the levels in assets/levels,
+# for testing how the game holds up on levels of any size. Run from the root
+# of the project:
+#
+#     python tools/generate_level.py assets/levels/big.json --width 1000
+#
+# The same seed always gives the same level.
+
+# Imports
+import argparse
+import json
+import random
+
+# Settings
+SCALE = 64
+MUSIC = "assets/sounds/theme.ogg"
+BACKGROUND = { "color": [0, 0, 0],
+               "image1": "assets/images/backgrounds/Sky.png",
+               "parallax_speed1": 0.6,
+               "image2": "assets/images/backgrounds/Hills_2.png",
+               "parallax_speed2": 0.3 }
+PHYSICS = { "gravity": 1.5, "terminal_velocity": 36 }
+
+# Nothing is put this close to the start or the end, so the hero has room to get going
+# and the flag stays clear
+MARGIN = 6
+
+# Enemies and gems need at least one column between the margins, and the goal is five
+# tiles tall on top of the ground (which also leaves two rows for platforms)
+MIN_WIDTH = 2 * MARGIN + 1
+MIN_HEIGHT = 6
+
+def generate_level(width=48, height=9, density=0.15, enemies=4, items=4, seed=0):
+    '''
+    Returns the map data for a level width by height tiles. The bottom
+    row is ground, and density is the chance of a column starting a
+    floating platform (two to five tiles long). Basic enemies walk on
+    the ground, platform enemies patrol platforms, and gems float
+    anywhere above the ground. Levels smaller than MIN_WIDTH by
+    MIN_HEIGHT raise a ValueError.
+    '''
+    if width < MIN_WIDTH or height < MIN_HEIGHT:
+        raise ValueError("levels need to be at least {}x{} tiles".format(MIN_WIDTH, MIN_HEIGHT))
+
+    rnd = random.Random(seed)
+    ground = height - 1
+    end = width - MARGIN
+
+    main = [[x, ground, "Grass"] for x in range(width)]
+    foreground = []
+    platforms = []
+    x = MARGIN
+
+    while x < end:
+        if rnd.random() < density:
+            y = rnd.randint(2, ground - 2)
+            length = min(rnd.randint(2, 5), end - x)
+
+            for i in range(length):
+                main.append([x + i, y, "Platform"])
+                platforms.append([x + i, y])
+
+            x += length + 1
+        else:
+            if rnd.random() < 0.1:
+                foreground.append([x, ground - 1, "Plant"])
+
+            x += 1
+
+    goal_x = width - 4
+    midground = [[goal_x + 0.8, ground - 4, "FlagTop"]]
+    midground += [[goal_x + 0.8, y, "FlagPole"] for y in range(ground - 3, ground)]
+
+    enemy_list = []
+
+    for i in range(enemies):
+        if len(platforms) > 0 and rnd.random() < 0.5:
+            x, y = rnd.choice(platforms)
+            enemy_list.append([x, y - 1, "PlatformEnemy"])
+        else:
+            enemy_list.append([rnd.randint(MARGIN, end - 1), ground - 1, "BasicEnemy"])
+
+    item_list = [[rnd.randint(MARGIN, end - 1), rnd.randint(1, ground - 1), "Gem"] for i in range(items)]
+
+    return { "layout": { "scale": SCALE,
+                         "size": [width, height],
+                         "start": [1, ground - 1],
+                         "goal": [goal_x, ground - 5, 2, 5] },
+             "physics": PHYSICS,
+             "music": MUSIC,
+             "background": BACKGROUND,
+             "tiles": { "midground": midground,
+                        "main": main,
+                        "foreground": foreground },
+             "items": item_list,
+             "enemies": enemy_list }
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a random level.")
+    parser.add_argument("path", help="where to write the level JSON")
+    parser.add_argument("--width", type=int, default=48, help="width in tiles")
+    parser.add_argument("--height", type=int, default=9, help="height in tiles")
+    parser.add_argument("--density", type=float, default=0.15,
+                        help="chance of each column starting a platform")
+    parser.add_argument("--enemies", type=int, default=4, help="number of enemies")
+    parser.add_argument("--items", type=int, default=4, help="number of gems")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    if args.width < MIN_WIDTH or args.height < MIN_HEIGHT:
+        parser.error("levels need to be at least {}x{} tiles".format(MIN_WIDTH, MIN_HEIGHT))
+
+    data = generate_level(args.width, args.height, args.density, args.enemies, args.items, args.seed)
+
+    with open(args.path, 'w') as f:
+        json.dump(data, f)
+
+    print(args.path + ": " + str(args.width) + "x" + str(args.height) + " tiles")
+
+if __name__ == "__main__":
+    main()